@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""Time each phase of the reference filter, and the memory it uses,
+on synthetic documents in every output format. Doesn't need pandoc.
+
+usage: python benchmarks/filter_phases.py [--sections N] [--figures N]
+           [--equations N] [--citations N] [--multi-citations N]
+           [--output results.json] [--compare old.json]
+
+Each format is timed with the actions of reference_filter applied
+one pandocfilters.walk at a time, copying the document each time
+('copying'), one in place walk at a time ('actions') and with the
+passes that main() uses ('passes'), which skip what can't contain
+references. Times are the best of --repeat runs. Peak memory (which
+for the in place walks should be small next to the memory of the
+document itself, also reported) is measured with tracemalloc in a
+separate run, as are the allocations of each phase: the number and
+size of the blocks of memory allocated by the phase that are still
+in use at its end, from the difference of tracemalloc snapshots.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import internalreferences  # noqa
+import synthetic  # noqa
+
+formats = ('latex', 'html', 'html5', 'markdown', '')
+
+
+def phases(refmanager, mode):
+    """The named phases of the filter, as functions of (doc, format,
+    metadata) that are called on the document in turn."""
+    def walk(actions):
+        return lambda doc, format, metadata: internalreferences.walk(
+            doc, actions, format, metadata)
+
+    def copying_walk(action):
+        def phase(doc, format, metadata):
+            doc[:] = internalreferences.pf.walk(doc, action, format,
+                                                metadata)
+        return phase
+
+    if mode == 'copying':
+        return [(action.__name__, copying_walk(action))
+                for action in refmanager.reference_filter]
+    elif mode == 'actions':
+        return [(action.__name__, walk([action]))
+                for action in refmanager.reference_filter]
+    elif mode == 'passes':
+        collect, rewrite = refmanager.reference_passes
+        marked = []
+
+        def collect_pass(doc, format, metadata):
+            marked[:] = internalreferences.collect_pass(
+                doc, collect, refmanager, format, metadata)
+
+        def rewrite_pass(doc, format, metadata):
+            internalreferences.rewrite_pass(
+                doc, rewrite, refmanager, marked, format, metadata)
+
+        return [('collect', collect_pass), ('rewrite', rewrite_pass)]
+
+
+def run(text, format, mode, measure):
+    """Filter the document, returning a measurement of each phase."""
+    doc = json.loads(text)
+    metadata = doc[0]['unMeta']
+    refmanager = internalreferences.document_manager(metadata)
+
+    results = {}
+    for name, phase in phases(refmanager, mode):
+        results[name] = measure(lambda: phase(doc, format, metadata))
+    return results
+
+
+def elapsed(f):
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+
+def peak_memory(f):
+    tracemalloc.start()
+    try:
+        f()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def allocations(f):
+    """The number and total size of the blocks allocated by f and
+    not freed by the time it returns."""
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        f()
+        after = tracemalloc.take_snapshot().filter_traces(ignore)
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    return {'blocks': sum(stat.count_diff for stat in stats),
+            'size': sum(stat.size_diff for stat in stats)}
+
+
+def benchmark(text, repeat):
+    results = {}
+    for format in formats:
+        results[format or 'generic'] = by_mode = {}
+        for mode in ('copying', 'actions', 'passes'):
+            times = [run(text, format, mode, elapsed) for _ in range(repeat)]
+            memory = run(text, format, mode, peak_memory)
+            allocated = run(text, format, mode, allocations)
+            by_mode[mode] = {name: {'time': min(t[name] for t in times),
+                                    'peak_memory': memory[name],
+                                    'allocations': allocated[name]}
+                             for name in memory}
+    return results
+
+
+def document_memory(text):
+    """The memory used by the loaded document."""
+    tracemalloc.start()
+    try:
+        doc = json.loads(text)
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del doc
+    return size
+
+
+def commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      stderr=subprocess.STDOUT)
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, compare=None):
+    print('document: {} kB'.format(results['document_memory'] // 1024))
+    row = '{:<9} {:<8} {:<24} {:>10} {:>12} {:>9} {:>10}'
+    print(row.format('format', 'mode', 'phase', 'time (s)', 'peak (kB)',
+                     'allocs', 'alloc (kB)')
+          + ('  change' if compare else ''))
+    for format, by_mode in results['results'].items():
+        for mode, by_phase in by_mode.items():
+            for phase, r in by_phase.items():
+                line = row.format(format, mode, phase,
+                                  '{:.4f}'.format(r['time']),
+                                  r['peak_memory'] // 1024,
+                                  r['allocations']['blocks'],
+                                  r['allocations']['size'] // 1024)
+                try:
+                    old = compare['results'][format][mode][phase]
+                    line += '  {:+.0%}'.format(r['time'] / old['time'] - 1)
+                except (TypeError, KeyError, ZeroDivisionError):
+                    pass
+                print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sections', type=int, default=1000)
+    parser.add_argument('--figures', type=int, default=1000)
+    parser.add_argument('--equations', type=int, default=1000)
+    parser.add_argument('--citations', type=int, default=2000)
+    parser.add_argument('--multi-citations', type=int, default=500)
+    parser.add_argument('--code-blocks', type=int, default=0)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='save the results as json')
+    parser.add_argument('--compare', help='results json to compare with')
+    args = parser.parse_args()
+
+    params = {'sections': args.sections,
+              'figures': args.figures,
+              'equations': args.equations,
+              'citations': args.citations,
+              'multi_citations': args.multi_citations,
+              'code_blocks': args.code_blocks,
+              'depth': args.depth}
+    text = json.dumps(synthetic.document(**params))
+
+    results = {'commit': commit(),
+               'python': platform.python_version(),
+               'json': internalreferences.json_backend.name,
+               'document': params,
+               'document_memory': document_memory(text),
+               'results': benchmark(text, args.repeat)}
+
+    compare = None
+    if args.compare:
+        with open(args.compare) as f:
+            compare = json.load(f)
+
+    report(results, compare)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
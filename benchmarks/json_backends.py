@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Time parsing and dumping a pandoc document with each of the
+available json backends.
+
+usage: python benchmarks/json_backends.py [document.json] [--copies N]
+
+The document defaults to tests/spec.json, with its blocks repeated
+--copies times to make it bigger.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import internalreferences  # noqa
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('document', nargs='?',
+                        default=os.path.join(os.path.dirname(__file__), '..',
+                                             'tests', 'spec.json'))
+    parser.add_argument('--copies', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with io.open(args.document, encoding='utf-8') as f:
+        meta, blocks = json.load(f)
+    text = json.dumps([meta, blocks * args.copies])
+
+    print('{:<8} {:>10} {:>10}  ({:.1f} MB)'.format(
+        'backend', 'parse (s)', 'dump (s)', len(text) / 1e6))
+
+    for name in internalreferences.JSONBackend.json_backends:
+        try:
+            backend = internalreferences.JSONBackend(name)
+        except ImportError:
+            print('{:<8} not installed'.format(name))
+            continue
+
+        doc = backend.loads(text)
+        parse = min(timeit.repeat(lambda: backend.loads(text),
+                                  number=1, repeat=args.repeat))
+        dump = min(timeit.repeat(lambda: backend.dumps(doc),
+                                 number=1, repeat=args.repeat))
+        print('{:<8} {:>10.4f} {:>10.4f}'.format(name, parse, dump))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Measure the memory used by the references of a document, as kept
+by ReferenceManager in a ReferenceStore, against a dict of Reference
+tuples with a dict of positions (as they were kept before).
+
+usage: python benchmarks/reference_memory.py [--sections N]
+           [--figures N] [--equations N] [--output results.json]
+
+The references are collected from a synthetic document (no pandoc
+needed) and then copied into each layout while tracemalloc is
+running, so that only the memory of the layout itself is counted.
+The time to look up every label is also reported.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import internalreferences  # noqa
+import synthetic  # noqa
+
+
+def collect(doc):
+    refmanager = internalreferences.document_manager(
+        {}, internalreferences.PandocAST())
+    collect, _ = refmanager.reference_passes
+    internalreferences.collect_pass(doc, collect, refmanager, '', {})
+    return refmanager.references
+
+
+def store_layout(references):
+    store = internalreferences.ReferenceStore()
+    for label, ref in references.items():
+        store.add(ref.type, ref.id, label)
+        store.locate(label, *references.position(label))
+    return store
+
+
+def dict_layout(references):
+    refs = {}
+    positions = {}
+    for label, ref in references.items():
+        refs[label] = internalreferences.Reference(ref.type, ref.id, label)
+        positions[label] = references.position(label)
+    return refs, positions
+
+
+def measure(build, references):
+    tracemalloc.start()
+    try:
+        layout = build(references)
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return layout, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sections', type=int, default=100000)
+    parser.add_argument('--figures', type=int, default=10000)
+    parser.add_argument('--equations', type=int, default=100000)
+    parser.add_argument('--output', help='save the results as json')
+    args = parser.parse_args()
+
+    params = {'sections': args.sections,
+              'figures': args.figures,
+              'equations': args.equations,
+              'citations': 0,
+              'multi_citations': 0}
+    references = collect(synthetic.document(**params))
+    labels = list(references)
+
+    results = {'python': platform.python_version(),
+               'document': params,
+               'references': len(labels),
+               'layouts': {}}
+    for name, build in (('dict', dict_layout), ('store', store_layout)):
+        layout, size = measure(build, references)
+        get = layout[0].get if name == 'dict' else layout.get
+        time = min(timeit.repeat(lambda: [get(label) for label in labels],
+                                 number=1, repeat=3))
+        results['layouts'][name] = {'memory': size, 'lookup': time}
+        del layout
+
+    print('{} references'.format(len(labels)))
+    row = '{:<6} {:>12} {:>12} {:>12}'
+    print(row.format('layout', 'memory (kB)', 'bytes/ref', 'lookup (s)'))
+    for name, r in results['layouts'].items():
+        print(row.format(name, r['memory'] // 1024,
+                         r['memory'] // max(len(labels), 1),
+                         '{:.4f}'.format(r['lookup'])))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
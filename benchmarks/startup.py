@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""Time starting the filter, as pandoc does once per document.
+Doesn't need pandoc.
+
+usage: python benchmarks/startup.py [--repeat N] [--top N]
+           [--output results.json] [--compare old.json]
+
+The imports are measured with `python -X importtime`, which gives the
+time to import internalreferences and the modules that take longest
+to import. The cold start is the wall time of running the filter (and
+the client, with no server running) in a new python on a small
+document with references and on one with nothing for the filter to
+do, which is passed straight through. Times are the best of --repeat
+runs.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import synthetic  # noqa
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def environment():
+    env = dict(os.environ, PYTHONPATH=root,
+               INTERNAL_REFERENCES_SOCKET=os.path.join(
+                   tempfile.gettempdir(), 'no-internal-references.sock'))
+    for name in ('INTERNAL_REFERENCES_CACHE', 'INTERNAL_REFERENCES_STREAM',
+                 'INTERNAL_REFERENCES_PROFILE'):
+        env.pop(name, None)
+    return env
+
+
+def import_times():
+    """The self and cumulative import times of each module imported
+    by internalreferences, in microseconds, from -X importtime.
+    """
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                             'import internalreferences'],
+                            env=environment(), stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    times = {}
+    for line in err.decode().splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = {'self': int(self_time),
+                               'cumulative': int(cumulative)}
+    return times
+
+
+def cold_start(script, args, data):
+    """The wall time of filtering data with script in a new python."""
+    with tempfile.TemporaryFile() as f, open(os.devnull, 'wb') as null:
+        f.write(data)
+        f.seek(0)
+        start = time.time()
+        subprocess.check_call([sys.executable, os.path.join(root, script)]
+                              + args, stdin=f, stdout=null,
+                              env=environment())
+        return time.time() - start
+
+
+def documents():
+    plain = [{'unMeta': {}},
+             [{'t': 'Para', 'c': [synthetic.Str('word')] * 20}] * 100]
+    small = synthetic.document(sections=10, figures=10, equations=10,
+                               citations=20, multi_citations=5)
+    return [('references', json.dumps(small).encode('utf-8')),
+            ('passthrough', json.dumps(plain).encode('utf-8'))]
+
+
+def benchmark(repeat):
+    results = {}
+    for script in ('internalreferences.py', 'internalreferences_client.py'):
+        for name, data in documents():
+            times = [cold_start(script, ['html'], data)
+                     for _ in range(repeat)]
+            results['{} {}'.format(script[:-3], name)] = min(times)
+    return results
+
+
+def commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      stderr=subprocess.STDOUT)
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, top, compare=None):
+    imports = results['imports']
+    total = imports['internalreferences']['cumulative']
+    print('import internalreferences: {:.1f} ms'.format(total / 1000.))
+    print('slowest imports (self, cumulative ms):')
+    slowest = sorted(imports.items(), key=lambda item: -item[1]['self'])
+    for name, t in slowest[:top]:
+        print('  {:<32} {:>7.1f} {:>7.1f}'.format(
+            name, t['self'] / 1000., t['cumulative'] / 1000.))
+
+    print('cold start (s):')
+    for name, t in results['cold_start'].items():
+        line = '  {:<40} {:.4f}'.format(name, t)
+        try:
+            line += '  {:+.0%}'.format(t / compare['cold_start'][name] - 1)
+        except (TypeError, KeyError, ZeroDivisionError):
+            pass
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--output', help='save the results as json')
+    parser.add_argument('--compare', help='results json to compare with')
+    args = parser.parse_args()
+
+    results = {'commit': commit(),
+               'python': platform.python_version(),
+               'imports': min((import_times() for _ in range(args.repeat)),
+                              key=lambda t: t['internalreferences']
+                              ['cumulative']),
+               'cold_start': benchmark(args.repeat)}
+
+    compare = None
+    if args.compare:
+        with open(args.compare) as f:
+            compare = json.load(f)
+
+    report(results, args.top, compare)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Generate synthetic pandoc json documents for benchmarking,
+without needing pandoc.
+"""
+import random
+
+
+def Str(s):
+    return {'t': 'Str', 'c': s}
+
+
+def Space():
+    return {'t': 'Space', 'c': []}
+
+
+def words(text):
+    inlines = []
+    for word in text.split():
+        if inlines:
+            inlines.append(Space())
+        inlines.append(Str(word))
+    return inlines
+
+
+def citation(label):
+    return {'citationId': label,
+            'citationPrefix': [],
+            'citationSuffix': [],
+            'citationMode': {'t': 'NormalCitation', 'c': []},
+            'citationNoteNum': 0,
+            'citationHash': 0}
+
+
+def cite(labels):
+    text = '[' + '; '.join('@' + label for label in labels) + ']'
+    return {'t': 'Cite', 'c': [[citation(label) for label in labels],
+                               words(text)]}
+
+
+def header(n, level):
+    return {'t': 'Header', 'c': [level, ['sec:{}'.format(n), [], []],
+                                 words('Section number {}'.format(n))]}
+
+
+def figure(n):
+    image = {'t': 'Image', 'c': [words('Caption of figure {}'.format(n)),
+                                 ['figure{}.png'.format(n), '']]}
+    if n % 2:
+        div = [['fig:{}'.format(n), ['figure'], []],
+               [{'t': 'Para', 'c': [image]}]]
+        return {'t': 'Div', 'c': div}
+    else:
+        attr = words('{{#fig:{} .wide width=50%}}'.format(n))
+        return {'t': 'Para', 'c': [image] + attr}
+
+
+def equation(n):
+    math = 'x_{{{n}}} = {n} \\label{{eq:{n}}}'.format(n=n)
+    return {'t': 'Para', 'c': [{'t': 'Math',
+                                'c': [{'t': 'DisplayMath', 'c': []}, math]}]}
+
+
+def code_block(n, lines=20):
+    code = '\n'.join('line {} of code block {}'.format(i, n)
+                     for i in range(lines))
+    return {'t': 'CodeBlock', 'c': [['', ['python'], []], code]}
+
+
+def spread(count, bins):
+    """Split count items as evenly as possible over bins."""
+    return [count // bins + (i < count % bins) for i in range(bins)]
+
+
+def document(sections=100, figures=100, equations=100, citations=200,
+             multi_citations=50, code_blocks=0, depth=3, seed=0):
+    """A pandoc document (old style json, with unMeta) with the given
+    numbers of each kind of object, spread evenly over the sections.
+    Headers nest to the given depth. Citations refer to random
+    labels of any type, multi citations to between two and five.
+    """
+    rng = random.Random(seed)
+    labels = (['sec:{}'.format(n) for n in range(sections)]
+              + ['fig:{}'.format(n) for n in range(figures)]
+              + ['eq:{}'.format(n) for n in range(equations)])
+
+    bins = max(sections, 1)
+    per_section = zip(spread(figures, bins),
+                      spread(equations, bins),
+                      spread(citations, bins),
+                      spread(multi_citations, bins),
+                      spread(code_blocks, bins))
+
+    blocks = []
+    counts = [0, 0, 0]
+    for n, (nfig, neq, ncite, nmulti, ncode) in enumerate(per_section):
+        if n < sections:
+            blocks.append(header(n, 1 + n % depth))
+        for _ in range(nfig):
+            blocks.append(figure(counts[0]))
+            counts[0] += 1
+        for _ in range(neq):
+            blocks.append(equation(counts[1]))
+            counts[1] += 1
+        for _ in range(ncode):
+            blocks.append(code_block(counts[2]))
+            counts[2] += 1
+        for _ in range(ncite):
+            para = words('As shown in') + [Space(), cite([rng.choice(labels)])]
+            blocks.append({'t': 'Para', 'c': para})
+        for _ in range(nmulti):
+            refs = rng.sample(labels, min(len(labels), rng.randint(2, 5)))
+            para = words('See also') + [Space(), cite(refs)]
+            blocks.append({'t': 'Para', 'c': para})
+
+    return [{'unMeta': {}}, blocks]
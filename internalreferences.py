@@ -1,10 +1,35 @@
 #!/usr/bin/env python
+import io
+import os
 import re
-from collections import OrderedDict
+import string
+import time
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
 
 import pandocfilters as pf
 
-from pandocattributes import PandocAttributes
+# the rest of the standard library (and pandocattributes) is imported
+# where it is used, so that starting the filter for a document that
+# doesn't need them is quick
+from internalreferences_client import needs_filter, owned, socket_path
+
+if pf.sys.version_info < (3, 7):
+    from pandocattributes import PandocAttributes
+
+
+def __getattr__(name):
+    """Import PandocAttributes when it is first looked up here, as it
+    was imported at the top of the module before it was deferred."""
+    if name == 'PandocAttributes':
+        from pandocattributes import PandocAttributes
+        return PandocAttributes
+    raise AttributeError('module {!r} has no attribute {!r}'
+                         .format(__name__, name))
+
+
+timer = getattr(time, 'perf_counter', time.time)
 
 
 def RawInline(format, string):
@@ -29,10 +54,51 @@ def isheader(key, value):
     return (key == 'Header')
 
 
-math_label = r'\\label{(.*?)}'
+math_label = re.compile(r'\\label{(.*?)}')
+
+
+def find_math_labels(math):
+    """All of the labels in a math string, in order. Most math has no
+    labels, so check for that before using the regex.
+    """
+    if '\\label' not in math:
+        return ()
+    return tuple(math_label.findall(math))
+
 
 def islabeledmath(key, value):
-    return (key == 'Math' and re.search(math_label, value[1]))
+    return (key == 'Math' and bool(find_math_labels(value[1])))
+
+
+def stringify(x):
+    """Concatenate the string content of x, leaving out all
+    formatting, as pandocfilters.stringify does but without walking
+    (and so copying) the tree.
+    """
+    result = []
+    append = result.append
+
+    def go(x):
+        if isinstance(x, list):
+            for item in x:
+                if isinstance(item, dict) and 't' in item:
+                    key = item['t']
+                    if key in ('Str', 'MetaString'):
+                        append(item['c'])
+                        continue
+                    elif key in ('Code', 'Math'):
+                        append(item['c'][1])
+                        continue
+                    elif key in ('Space', 'SoftBreak', 'LineBreak'):
+                        append(' ')
+                        continue
+                go(item)
+        elif isinstance(x, dict):
+            for v in x.values():
+                go(v)
+
+    go(x)
+    return ''.join(result)
 
 
 def isattr(string):
@@ -42,6 +108,10 @@ def isattr(string):
 # define a new Figure type - an image with attributes
 Figure = pf.elt('Figure', 3)  # caption, target, attrs
 
+# Links and Images of the versioned pandoc api, which have attributes
+AttrLink = pf.elt('Link', 3)  # attr, inlines, target
+AttrImage = pf.elt('Image', 3)  # attr, caption, target
+
 
 def isfigure(key, value):
     return (key == 'Para' and len(value) == 2 and value[0]['t'] == 'Image')
@@ -50,7 +120,7 @@ def isfigure(key, value):
 def isattrfigure(key, value):
     return (key == 'Para'
             and value[0]['t'] == 'Image'
-            and isattr(pf.stringify(value[1:])))
+            and isattr(stringify(value[1:])))
 
 
 def isdivfigure(key, value):
@@ -62,21 +132,64 @@ def isFigure(key, value):
     return key == 'Figure'
 
 
-def create_pandoc_multilink(strings, refs):
-    inlines = [[pf.Str(str(s))] for s in strings]
-    targets = [(r, "") for r in refs]
-    links = [pf.Link(inline, target)
-             for inline, target in zip(inlines, targets)]
+def number_key(n):
+    """Sort key for a reference number, e.g. 3 or '1.2.4', or None if
+    it isn't numeric.
+    """
+    try:
+        return tuple(int(i) for i in str(n).split('.'))
+    except ValueError:
+        return None
+
+
+def consecutive_runs(refs):
+    """Sort refs by number and split them into runs of consecutive
+    numbers, i.e. that differ by one in the last place (1.1, 1.2).
+
+    Refs without numeric numbers are left in order, one per run.
+    """
+    keys = [number_key(ref.id) for ref in refs]
+    if None in keys:
+        return [[ref] for ref in refs]
+
+    runs = []
+    last = None
+    for key, ref in sorted(zip(keys, refs), key=lambda x: x[0]):
+        if last and key[:-1] == last[:-1] and key[-1] == last[-1] + 1:
+            runs[-1].append(ref)
+        else:
+            runs.append([ref])
+        last = key
+    return runs
+
+
+def create_pandoc_multilink(refs, range_separator=u'\u2013', min_range=3,
+                            Link=pf.Link, **separators):
+    """Links to each of the refs, joined as by join_items, with runs
+    of at least min_range consecutive numbers written as a range,
+    e.g. '1\u20134 and 7'.
+    """
+    def link(ref):
+        return Link([pf.Str(str(ref.id))], ('#' + ref.label, ''))
+
+    items = []
+    for run in consecutive_runs(refs):
+        if min_range and len(run) >= min_range:
+            items.append([link(run[0]), pf.Str(range_separator),
+                          link(run[-1])])
+        else:
+            items.extend([link(ref)] for ref in run)
 
-    return join_items(links)
+    return join_items(items, method='extend', **separators)
 
 
-def create_latex_multilink(labels):
+def create_latex_multilink(labels, **separators):
     links = ['\\ref{{{label}}}'.format(label=label) for label in labels]
-    return join_items(links, call=str)
+    return join_items(links, call=str, **separators)
 
 
-def join_items(items, method='append', call=pf.Str):
+def join_items(items, method='append', call=pf.Str,
+               separator=', ', last_separator=' and '):
     """Join the list of items together in the format
 
     'item[0]' if len(items) == 1
@@ -94,15 +207,248 @@ def join_items(items, method='append', call=pf.Str):
         return out
 
     for item in items[1: -1]:
-        out.append(call(', '))
+        out.append(call(separator))
         join_to_out(item)
 
-    out.append(call(' and '))
+    out.append(call(last_separator))
     join_to_out(items[-1])
 
     return out
 
 
+# objects whose contents can't contain anything that the filter acts
+# on, so don't need to be walked
+opaque_types = frozenset(['Code', 'CodeBlock', 'RawBlock', 'RawInline',
+                          'Math'])
+
+
+def walk(x, actions, format, meta, skip=()):
+    """Walk the tree x in place, applying a list of actions to every
+    object in a single traversal.
+
+    Each object is passed through the actions in series, so that
+    walk(doc, [a, b], ...) has the same effect as walking the
+    document with a and then walking the result with b, but without
+    rebuilding every list and dict in the tree on each pass.
+
+    The actions have the same form as for pandocfilters.walk. When an
+    action returns a replacement, the replacement is passed to the
+    remaining actions and spliced into the parent list. Replacements
+    are taken to be complete and are not descended into.
+
+    Objects with a type in skip are passed to the actions, but their
+    contents aren't walked.
+
+    Nothing is copied: lists are only changed where an object is
+    replaced, and the contents of an object are walked directly.
+    """
+    if isinstance(x, list):
+        i = 0
+        while i < len(x):
+            item = x[i]
+            if isinstance(item, dict) and 't' in item:
+                res = apply_actions(item, actions, format, meta)
+                if res is None:
+                    if item['t'] not in skip:
+                        contents = item.get('c')
+                        if isinstance(contents, (list, dict)):
+                            walk(contents, actions, format, meta, skip)
+                    i += 1
+                else:
+                    x[i:i + 1] = res
+                    i += len(res)
+            else:
+                walk(item, actions, format, meta, skip)
+                i += 1
+    elif isinstance(x, dict):
+        for v in x.values():
+            walk(v, actions, format, meta, skip)
+    return x
+
+
+def walk_item(x, i, actions, format, meta, skip=()):
+    """Walk the single object x[i] in place, as walk does for each
+    item of a list. Returns the number of objects that are now in its
+    place.
+    """
+    item = x[i]
+    if isinstance(item, dict) and 't' in item:
+        res = apply_actions(item, actions, format, meta)
+        if res is not None:
+            x[i:i + 1] = res
+            return len(res)
+        if item['t'] in skip:
+            return 1
+        item = item.get('c')
+    if isinstance(item, (list, dict)):
+        walk(item, actions, format, meta, skip)
+    return 1
+
+
+def collect_pass(doc, actions, refmanager, format, meta, splits=None):
+    """Walk the first of the reference_passes over the document in
+    place, skipping the contents of opaque_types.
+
+    Returns the indices of the top level blocks that have anything in
+    them for the rewrite pass to act on (a figure, header, labelled
+    equation or citation), as noted by refmanager.consume_references.
+
+    If splits is a list, the places where the marked blocks can be
+    divided between parallel rewrites are appended to it, as
+    (position in the marked indices, figure count at that block).
+    """
+    walk(refmanager.ast.meta(doc), actions, format, meta, opaque_types)
+
+    blocks = refmanager.ast.blocks(doc)
+    marked = []
+    i = 0
+    n = 0
+    while i < len(blocks):
+        refmanager.rewrites = False
+        refmanager.block = n
+        figure_count = refmanager.figure_count
+        count = walk_item(blocks, i, actions, format, meta, opaque_types)
+        if refmanager.rewrites:
+            if splits is not None:
+                splits.append((len(marked), figure_count))
+            marked.extend(range(i, i + count))
+        i += count
+        n += 1
+    return marked
+
+
+def rewrite_pass(doc, actions, refmanager, marked, format, meta):
+    """Walk the second of the reference_passes over the metadata and
+    the top level blocks that are marked by collect_pass, in place.
+    """
+    walk(refmanager.ast.meta(doc), actions, format, meta, opaque_types)
+
+    blocks = refmanager.ast.blocks(doc)
+    offset = 0
+    for i in marked:
+        count = walk_item(blocks, i + offset, actions, format, meta,
+                          opaque_types)
+        offset += count - 1
+
+
+# the smallest number of marked blocks to rewrite in parallel, and the
+# number of chunks to split them into for each process. These are
+# guesses, not tuned: no speedup has been measured yet (only on a single
+# cpu, where the pool is slower), which is why rewriting in parallel is
+# off unless asked for
+parallel_min_blocks = 2000
+parallel_chunks = 4
+
+
+def rewrite_blocks(refmanager, blocks, figure_count, format, meta):
+    """Walk the rewrite pass over some of the marked top level blocks
+    in a worker process, starting from the given figure count.
+
+    Returns the replacement blocks for each block, the diagnostics
+    found and the figure count at the end.
+    """
+    refmanager.fig_replacement_count = figure_count
+    refmanager.diagnostics = []
+    _, rewrite = refmanager.reference_passes
+
+    replacements = []
+    for block in blocks:
+        replacement = [block]
+        walk_item(replacement, 0, rewrite, format, meta, opaque_types)
+        replacements.append(replacement)
+    return (replacements, refmanager.diagnostics,
+            refmanager.fig_replacement_count)
+
+
+def parallel_rewrite_pass(doc, actions, refmanager, marked, splits, format,
+                          meta, processes=None):
+    """Walk the second of the reference_passes over the document as
+    rewrite_pass does, but with the marked blocks divided between a
+    pool of processes, as they only depend on the references that
+    collect_pass found. The splits are those found by collect_pass.
+    Each process is sent its chunk of the blocks and the references,
+    not the whole document.
+
+    The output is the same as rewrite_pass, which is used instead
+    for documents with fewer than parallel_min_blocks marked blocks,
+    or if a pool of processes can't be made.
+    """
+    if len(marked) < parallel_min_blocks:
+        return rewrite_pass(doc, actions, refmanager, marked, format, meta)
+
+    import copy
+    import multiprocessing
+    try:
+        from concurrent import futures
+        if not processes:
+            processes = multiprocessing.cpu_count()
+        executor = futures.ProcessPoolExecutor(processes)
+    except (ImportError, NotImplementedError, OSError):
+        return rewrite_pass(doc, actions, refmanager, marked, format, meta)
+
+    walk(refmanager.ast.meta(doc), actions, format, meta, opaque_types)
+
+    # what the rewrite pass needs of the manager, without the state
+    # of the collect pass
+    worker = copy.copy(refmanager)
+    worker.cited = {}
+    worker.multi_cited = []
+    worker.diagnostics = []
+    worker.math_label_cache = {}
+
+    blocks = refmanager.ast.blocks(doc)
+    size = -(-len(marked) // (processes * parallel_chunks))
+
+    with executor:
+        chunks = []
+        start, figure_count = splits[0]
+        for position, count in splits[1:] + [(len(marked), None)]:
+            if position - start >= size or count is None:
+                chunk = [blocks[i] for i in marked[start:position]]
+                chunks.append(executor.submit(
+                    rewrite_blocks, worker, chunk, figure_count, format,
+                    meta))
+                start, figure_count = position, count
+
+        offset = 0
+        start = 0
+        for chunk in chunks:
+            replacements, diagnostics, figure_count = chunk.result()
+            for i, replacement in zip(marked[start:], replacements):
+                blocks[i + offset:i + offset + 1] = replacement
+                offset += len(replacement) - 1
+            start += len(replacements)
+            refmanager.diagnostics.extend(diagnostics)
+
+    refmanager.fig_replacement_count = figure_count
+
+
+def apply_actions(item, actions, format, meta):
+    """Pass a single pandoc object through the actions in series.
+
+    Returns None if none of the actions replaced the object,
+    otherwise the list of objects that should replace it.
+    """
+    items = None
+    for action in actions:
+        if items is None:
+            res = action(item['t'], item.get('c'), format, meta)
+            if res is not None:
+                items = res if isinstance(res, list) else [res]
+        else:
+            altered = []
+            for obj in items:
+                res = action(obj['t'], obj.get('c'), format, meta)
+                if res is None:
+                    altered.append(obj)
+                elif isinstance(res, list):
+                    altered.extend(res)
+                else:
+                    altered.append(res)
+            items = altered
+    return items
+
+
 def create_figures(key, value, format, metadata):
     """Convert Images with attributes to Figures.
 
@@ -113,8 +459,9 @@ def create_figures(key, value, format, metadata):
     This isn't a supported pandoc type, we just use it internally.
     """
     if isattrfigure(key, value):
+        from pandocattributes import PandocAttributes
         image = value[0]
-        attr = PandocAttributes(pf.stringify(value[1:]), 'markdown')
+        attr = PandocAttributes(stringify(value[1:]), 'markdown')
         caption, target = image['c']
         return Figure(caption, target, attr.to_pandoc())
 
@@ -130,6 +477,355 @@ def create_figures(key, value, format, metadata):
         return None
 
 
+def first_image(x):
+    """The first Image in a list of pandoc objects, or None."""
+    if isinstance(x, (list, tuple)):
+        for item in x:
+            if isinstance(item, dict) and item.get('t') == 'Image':
+                return item
+            image = first_image(item)
+            if image is not None:
+                return image
+    elif isinstance(x, dict):
+        return first_image(x.get('c'))
+    return None
+
+
+class PandocAST(object):
+    """The layout of a pandoc document, and the shape of the objects
+    in it that the filter reads or creates.
+
+    This is the original json of pandoc before 1.16: the document is
+    [{'unMeta': metadata}, blocks] and Images and Links have no
+    attributes, so figures are found by create_figures and replaced
+    with our own Figure type. Later versions of the pandoc api are
+    handled by PandocAPI; pandoc_ast(doc) gives the right one for a
+    document, so that the version is only looked at once.
+    """
+    version = ()
+
+    create_figures = staticmethod(create_figures)
+
+    Link = staticmethod(pf.Link)
+
+    def meta(self, doc):
+        return doc[0]['unMeta']
+
+    def blocks(self, doc):
+        return doc[1]
+
+    def is_figure(self, key, value):
+        return isFigure(key, value)
+
+    def figure(self, value):
+        """The caption, (filename, title) and (id, classes, kvs) of a
+        figure."""
+        return value
+
+    def figure_block(self, attr, caption, filename):
+        """A figure for formats that don't have a figure style."""
+        image = pf.Image(caption, (filename, ''))
+        return pf.Div(attr, [pf.Para([image])])
+
+
+class PandocAPI(PandocAST):
+    """Documents with a pandoc-api-version (pandoc 1.18 on), which are
+    {'pandoc-api-version': version, 'meta': metadata, 'blocks': blocks}
+    and have attributes on Images and Links.
+
+    From api 1.23 (pandoc 3) images with a caption are parsed as
+    Figure blocks, which are used as they are. With older versions,
+    paragraphs of a single image with attributes are made into
+    Figure blocks by create_figures. Either way, only figures with
+    attributes (on the Figure or its image) are numbered.
+    """
+    no_attr = ['', [], []]
+
+    def __init__(self, version):
+        self.version = tuple(version)
+        self.native_figures = self.version >= (1, 23)
+
+    def meta(self, doc):
+        return doc['meta']
+
+    def blocks(self, doc):
+        return doc['blocks']
+
+    def Link(self, inlines, target):
+        return AttrLink(self.no_attr, inlines, target)
+
+    def create_figures(self, key, value, format, metadata):
+        """Convert images with attributes, either on their own in a
+        paragraph or in a Div with the 'figure' class, to Figures.
+        """
+        if key == 'Para' and value and value[0]['t'] == 'Image':
+            attr, caption, target = value[0]['c']
+            if len(value) > 1:
+                text = stringify(value[1:])
+                if not isattr(text):
+                    return None
+                from pandocattributes import PandocAttributes
+                attr = PandocAttributes(text, 'markdown').to_pandoc()
+            elif not any(attr):
+                return None
+            image = AttrImage(self.no_attr, caption, target)
+
+        elif isdivfigure(key, value):
+            attr, blocks = value
+            image = first_image(blocks)
+            if image is None:
+                return None
+            _, caption, _ = image['c']
+
+        else:
+            return None
+
+        return Figure(attr, [None, [pf.Plain(caption)]], [pf.Plain([image])])
+
+    def is_figure(self, key, value):
+        return key == 'Figure' and any(self.figure(value)[2])
+
+    def figure(self, value):
+        attr, (_short_caption, caption), body = value
+        image = first_image(body)
+        if image is None:
+            image_attr, target = self.no_attr, ('', '')
+        else:
+            image_attr, _, target = image['c']
+
+        id = attr[0] or image_attr[0]
+        classes = attr[1] + [c for c in image_attr[1] if c not in attr[1]]
+        kvs = attr[2] + image_attr[2]
+        return caption, target, (id, classes, kvs)
+
+    def figure_block(self, attr, caption, filename):
+        image = AttrImage(self.no_attr, caption, (filename, ''))
+        if self.native_figures:
+            return Figure(attr, [None, [pf.Plain(caption)]],
+                          [pf.Plain([image])])
+        return pf.Div(attr, [pf.Para([image])])
+
+
+def pandoc_ast(doc):
+    """The PandocAST for a document, from its pandoc-api-version."""
+    if isinstance(doc, dict):
+        return PandocAPI(doc['pandoc-api-version'])
+    return PandocAST()
+
+
+def html_attributes(id, classes, kvs):
+    """Format pandoc attributes as html, as PandocAttributes.to_html."""
+    id_str = 'id="{}"'.format(id) if id else ''
+    class_str = 'class="{}"'.format(' '.join(classes)) if classes else ''
+    key_str = ' '.join('{}={}'.format(k, v) for k, v in kvs)
+    return ' '.join((id_str, class_str, key_str)).strip()
+
+
+def unique_kvs(kvs):
+    """Merge repeated keys in pandoc key value pairs, as
+    PandocAttributes does.
+    """
+    if len(kvs) < 2 or len(set(k for k, _ in kvs)) == len(kvs):
+        return kvs
+    return [[k, v] for k, v in OrderedDict(kvs).items()]
+
+
+class FigureTemplate(object):
+    """A figure style from ReferenceManager.figure_styles, compiled
+    once into a %-format string of simple fields, so that rendering a
+    figure needs no attribute lookups or PandocAttributes.
+
+    Styles that use any other fields, or format specs, are rendered
+    with str.format and a PandocAttributes as before.
+    """
+    fields = ('attr.html', 'attr.id',
+              'filename', 'alt', 'fcaption', 'caption', 'star')
+
+    def __init__(self, template):
+        self.template = template
+        self.names = set()
+        parts = []
+        for literal, name, spec, conversion in string.Formatter().parse(
+                template):
+            parts.append(literal.replace('%', '%%'))
+            if name is None:
+                continue
+            if name not in self.fields or spec or conversion:
+                self.compiled = None
+                return
+            self.names.add(name)
+            parts.append('%({})s'.format(name))
+        self.compiled = u''.join(parts)
+
+    def render(self, id, classes, kvs, **values):
+        if self.compiled is None:
+            from pandocattributes import PandocAttributes
+            attr = PandocAttributes([id, classes, kvs])
+            return self.template.format(attr=attr, **values)
+
+        values['attr.id'] = id
+        if 'attr.html' in self.names:
+            values['attr.html'] = html_attributes(id, classes, kvs)
+        return self.compiled % values
+
+
+# a referencable object, stored by label in ReferenceManager.references
+Reference = namedtuple('Reference', ['type', 'id', 'label'])
+
+# the types of Reference, in the order of their codes in a
+# ReferenceStore and the binary reference table
+reference_types = ('figure', 'section', 'math')
+
+
+class ReferenceStore(object):
+    """The references of a document, by label, with where they are.
+
+    This is used as a dict of label: Reference, but documents can
+    have hundreds of thousands of references, so rather than a
+    Reference (and a position) for each one, the fields of all the
+    references are kept in parallel arrays, with only the index in
+    them stored by label. A Reference is made when one is looked up.
+    Each label is only stored once, as the key and in the arrays.
+    """
+    def __init__(self, references=()):
+        self.clear()
+        self.update(references)
+
+    def clear(self):
+        self.index = {}
+        self.labels = []
+        self.types = bytearray()
+        self.ids = []
+        # the position: the labels of the sections that the reference
+        # is in (outermost first), the top level block (-1 if unknown)
+        # and source position
+        self.sections = []
+        self.blocks = array('i')
+        self.pos = []
+
+    def add(self, type, id, label):
+        """Store a reference, replacing any with the same label."""
+        code = reference_types.index(type)
+        i = self.index.get(label)
+        if i is None:
+            self.index[label] = len(self.labels)
+            self.labels.append(label)
+            self.types.append(code)
+            self.ids.append(id)
+            self.sections.append(())
+            self.blocks.append(-1)
+            self.pos.append(None)
+        else:
+            self.types[i] = code
+            self.ids[i] = id
+
+    def locate(self, label, section, block, pos):
+        """Set the position of the reference with label."""
+        i = self.index[label]
+        self.sections[i] = section
+        self.blocks[i] = -1 if block is None else block
+        self.pos[i] = pos
+
+    def intern(self, label):
+        """The stored string equal to label, if there is one, so that
+        other tables of labels can share it."""
+        i = self.index.get(label)
+        return label if i is None else self.labels[i]
+
+    def position(self, label):
+        """The sections, block and source position of the reference
+        with label, or no sections and Nones if it isn't known.
+        """
+        i = self.index.get(label)
+        if i is None:
+            return (), None, None
+        block = self.blocks[i]
+        return self.sections[i], None if block < 0 else block, self.pos[i]
+
+    def reference(self, i):
+        return Reference._make((reference_types[self.types[i]],
+                                self.ids[i], self.labels[i]))
+
+    def get(self, label, default=None):
+        i = self.index.get(label)
+        if i is None:
+            return default
+        return Reference._make((reference_types[self.types[i]],
+                                self.ids[i], self.labels[i]))
+
+    def __getitem__(self, label):
+        return self.reference(self.index[label])
+
+    def __setitem__(self, label, ref):
+        self.add(ref.type, ref.id, label)
+
+    def __contains__(self, label):
+        return label in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def keys(self):
+        return list(self.labels)
+
+    def values(self):
+        return [self.reference(i) for i in range(len(self.labels))]
+
+    def items(self):
+        return [(label, self.reference(i))
+                for i, label in enumerate(self.labels)]
+
+    def update(self, references):
+        if hasattr(references, 'items'):
+            references = references.items()
+        for label, ref in references:
+            self[label] = ref
+
+
+# a problem with the references of a document: a 'duplicate' label, a
+# 'dangling' citation or a 'mismatch' between the two passes, with the
+# type of reference if known and the top level block it is in
+Diagnostic = namedtuple('Diagnostic', ['kind', 'label', 'type', 'block'])
+
+
+class ValidationError(Exception):
+    """Raised in strict mode when a document has Diagnostics."""
+    def __init__(self, diagnostics):
+        counts = Counter(d.kind for d in diagnostics)
+        Exception.__init__(self, ', '.join(
+            '{} {}'.format(n, kind) for kind, n in sorted(counts.items())))
+        self.diagnostics = diagnostics
+
+
+def diagnostics_report(diagnostics):
+    """The counts of each kind of Diagnostic and the diagnostics, as
+    json-able dicts."""
+    counts = Counter(d.kind for d in diagnostics)
+    return OrderedDict([('counts', OrderedDict(sorted(counts.items()))),
+                        ('diagnostics', [OrderedDict(zip(d._fields, d))
+                                         for d in diagnostics])])
+
+
+def write_diagnostics(diagnostics, f):
+    """Write a line for each Diagnostic, and the counts, to f."""
+    lines = []
+    for d in diagnostics:
+        where = [d.type] if d.type else []
+        if d.block is not None:
+            where.append('block {}'.format(d.block))
+        line = u'internal-references: {} label {}'.format(d.kind, d.label)
+        if where:
+            line += u' ({})'.format(', '.join(where))
+        lines.append(line)
+    if diagnostics:
+        lines.append(u'internal-references: {}'.format(
+            ValidationError(diagnostics)))
+        f.write(u'\n'.join(lines) + u'\n')
+
+
 class ReferenceManager(object):
     """Internal reference manager.
 
@@ -168,18 +864,21 @@ class ReferenceManager(object):
                       '\n'
                       '</div>\n')}
 
+    figure_templates = {}
+
     latex_multi_autolink = u'\\cref{{{labels}}}{post}'
 
-    section_count = [0, 0, 0, 0, 0, 0]
-    figure_count = 0
-    fig_replacement_count = 0
     auto_fig_id = '___fig___[{}]'.format
-    equation_count = 0
-    references = {}
+
+    # unresolved citations of labels starting with these are taken to
+    # be meant as internal references, rather than bibliographic
+    reference_prefixes = ('fig:', 'sec:', 'eq:')
 
     formats = ('html', 'html5', 'markdown', 'latex')
 
-    def __init__(self, autoref=True):
+    def __init__(self, autoref=True, separator=', ', last_separator=' and ',
+                 range_separator=u'\u2013', min_range=3, ast=None,
+                 numbering=None):
         if autoref:
             self.replacements = {'figure': 'Figure {}',
                                  'section': 'Section {}',
@@ -199,6 +898,69 @@ class ReferenceManager(object):
 
         self.autoref = autoref
 
+        # the layout of the documents, by default that of old pandoc
+        self.ast = ast or PandocAST()
+
+        # formatting of multiple references
+        self.separators = {'separator': separator,
+                           'last_separator': last_separator}
+        self.range_separator = range_separator
+        self.min_range = min_range
+
+        # the header level that figures and equations are numbered
+        # within, by type, e.g. {'figure': 1} for 'Figure 3.2'
+        self.numbering = dict(numbering or {})
+
+        # the references and where each one is: the label of the
+        # section that contains it, the top level block and the source
+        # position
+        self.references = ReferenceStore()
+        # the top level block being collected, set by collect_pass
+        self.block = None
+        # whether consume_references has seen anything that
+        # replace_references or convert_internal_refs acts on
+        self.rewrites = False
+        self.reset()
+
+    def reset(self, counters=None):
+        """Forget all document state, so that the manager can be
+        reused for another document.
+
+        Numbering starts from the given counters (as returned by
+        self.counters) if any, so that a document can continue the
+        numbering of the one before it.
+        """
+        counters = counters or {}
+        self.section_count = list(counters.get('section_count',
+                                               [0, 0, 0, 0, 0, 0]))
+        self.figure_count = counters.get('figure_count', 0)
+        self.fig_replacement_count = self.figure_count
+        self.equation_count = counters.get('equation_count', 0)
+        # counts of figures and equations within the current section
+        self.within_count = dict(counters.get('within_count', {}))
+        # the formatted number of the current section at each level
+        self.section_numbers = []
+        self.references.clear()
+        # for validate: the block each label is first cited in, the
+        # labels of each multiple citation and the problems found
+        self.cited = {}
+        self.multi_cited = []
+        self.diagnostics = []
+        # the (level, label) of the enclosing sections that have labels,
+        # and the labels as a tuple, which is shared by the positions
+        # of all the references in the same section
+        self.section_path = []
+        self.sections = ()
+        self.math_label_cache = {}
+
+    @property
+    def counters(self):
+        """The current state of the numbering."""
+        return {'section_count': list(self.section_count),
+                'figure_count': self.figure_count,
+                'equation_count': self.equation_count,
+                'within_count': dict(self.within_count)}
+
     def increment_section_count(self, header_level):
         """Changing the section count is dependent on the header level.
 
@@ -206,10 +968,18 @@ class ReferenceManager(object):
         count for all headers at a higher header level than that
         given, increment the count at the header level, and leave
         the same all lower levels.
+
+        Figures and equations that are numbered within sections of
+        this level or deeper start again from one.
         """
-        self.section_count[header_level - 1] += 1
-        for i, _ in enumerate(self.section_count[header_level:]):
-            self.section_count[header_level + i] = 0
+        count = self.section_count
+        count[header_level - 1] += 1
+        count[header_level:] = [0] * (len(count) - header_level)
+        del self.section_numbers[header_level - 1:]
+
+        for type, level in self.numbering.items():
+            if level >= header_level:
+                self.within_count[type] = 0
 
     def format_section_count(self, header_level):
         """Format the section count for a given header level,
@@ -217,45 +987,137 @@ class ReferenceManager(object):
 
         e.g. section_count = [1, 2, 4, 3]
         format_section_count(3) == '1.2.4'
+
+        The number at each level is only formatted once per section,
+        from the number of the level above.
+        """
+        numbers = self.section_numbers
+        while len(numbers) < header_level:
+            n = str(self.section_count[len(numbers)])
+            numbers.append(numbers[-1] + '.' + n if numbers else n)
+        return numbers[header_level - 1]
+
+    def number(self, type, count):
+        """The number of the figure or equation (type 'figure' or
+        'math') that is the count'th in the document: count itself,
+        or, if the type is numbered within sections, the number of the
+        section and the count within it, e.g. '3.2'.
+        """
+        level = self.numbering.get(type)
+        if not level:
+            return count
+        n = self.within_count[type] = self.within_count.get(type, 0) + 1
+        return '{}.{}'.format(self.format_section_count(level), n)
+
+    def math_labels(self, math):
+        """The labels in a math string, cached so that the math is
+        only searched once in the consume and replace passes.
         """
-        return '.'.join(str(i) for i in self.section_count[:header_level])
+        if '\\label' not in math:
+            return ()
+        try:
+            return self.math_label_cache[math]
+        except KeyError:
+            labels = self.math_label_cache[math] = find_math_labels(math)
+            return labels
+
+    def note_position(self, label, kvs=()):
+        """Record where the reference with label is, for
+        reference_table. The source position is the data-pos
+        attribute given by pandoc's sourcepos extension.
+        """
+        pos = None
+        for k, v in kvs:
+            if k == 'data-pos':
+                pos = v
+        self.references.locate(label, self.sections, self.block, pos)
 
     def consume_references(self, key, value, format, metadata):
         """Find all figures, sections and math in the document
         and append reference information to the reference state.
         """
-        if isFigure(key, value):
+        if self.ast.is_figure(key, value):
+            self.rewrites = True
             self.consume_figure(key, value, format, metadata)
         elif isheader(key, value):
+            self.rewrites = True
             self.consume_section(key, value, format, metadata)
-        elif islabeledmath(key, value):
+        elif key == 'Math' and self.math_labels(value[1]):
+            self.rewrites = True
             self.consume_math(key, value, format, metadata)
+        elif key == 'Cite':
+            self.rewrites = True
+            citations = value[0]
+            for citation in citations:
+                label = self.references.intern(citation['citationId'])
+                self.cited.setdefault(label, self.block)
+            if len(citations) > 1:
+                self.multi_cited.append([
+                    self.references.intern(citation['citationId'])
+                    for citation in citations])
+
+    def add_reference(self, type, id, label):
+        """Store the Reference for label, noting a duplicate if there
+        is already one."""
+        if label in self.references and label:
+            self.diagnostics.append(Diagnostic('duplicate', label, type,
+                                               self.block))
+        self.references.add(type, id, label)
+
+    def validate(self):
+        """The Diagnostics of the document, from the collect pass (and
+        the rewrite pass, if it has run).
+
+        Unresolved citations are usually bibliographic, so they are
+        only counted as dangling if their label starts with one of
+        reference_prefixes, or they are cited together with labels
+        that are references.
+        """
+        references = self.references
+        suspects = set()
+        for labels in self.multi_cited:
+            if any(label in references for label in labels):
+                suspects.update(labels)
+
+        dangling = [Diagnostic('dangling', label, None, block)
+                    for label, block in self.cited.items()
+                    if label not in references
+                    and (label in suspects
+                         or label.startswith(self.reference_prefixes))]
+        return self.diagnostics + dangling
+
+    def check(self):
+        """Raise a ValidationError if the document has Diagnostics."""
+        diagnostics = self.validate()
+        if diagnostics:
+            raise ValidationError(diagnostics)
 
     def replace_references(self, key, value, format, metadata):
         """Find all figures, sections and equations that can be
         referenced in the document and replace them with format
         appropriate substitutions.
         """
-        if isFigure(key, value):
+        if self.ast.is_figure(key, value):
             return self.figure_replacement(key, value, format, metadata)
         elif isheader(key, value):
             return self.section_replacement(key, value, format, metadata)
-        elif islabeledmath(key, value):
+        elif key == 'Math' and self.math_labels(value[1]):
             return self.math_replacement(key, value, format, metadata)
 
     def consume_figure(self, key, value, format, metadata):
         """If the key, value represents a figure, append reference
         data to internal state.
         """
-        _caption, (filename, target), (id, classes, kvs) = value
+        _caption, (filename, target), (id, classes, kvs) = \
+            self.ast.figure(value)
         if 'unnumbered' in classes:
             return
         else:
             self.figure_count += 1
             id = id or self.auto_fig_id(self.figure_count)
-            self.references[id] = {'type': 'figure',
-                                   'id': self.figure_count,
-                                   'label': id}
+            self.add_reference('figure',
+                               self.number('figure', self.figure_count), id)
+            self.note_position(id, kvs)
 
     def consume_section(self, key, value, format, metadata):
         """If the key, value represents a section, append reference
@@ -264,25 +1126,36 @@ class ReferenceManager(object):
         level, attr, text = value
         label, classes, kvs = attr
 
+        path = self.section_path
+        while path and path[-1][0] >= level:
+            path.pop()
+        self.sections = tuple(label for _, label in path)
+
         if 'unnumbered' in classes:
             return
         else:
             self.increment_section_count(level)
             secn = self.format_section_count(level)
-            self.references[label] = {'type': 'section',
-                                      'id': secn,
-                                      'label': label}
+            self.add_reference('section', secn, label)
+            self.note_position(label, kvs)
+            if label:
+                path.append((level, label))
+                self.sections += (label,)
 
     def consume_math(self, key, value, format, metadata):
         """If the key, value represents math, append reference
         data to internal state.
+
+        Each label in the math (e.g. for each line of an align
+        environment) is numbered as a separate equation.
         """
-        self.equation_count += 1
         mathtype, math = value
-        label, = re.search(math_label, math).groups()
-        self.references[label] = {'type': 'math',
-                                  'id': self.equation_count,
-                                  'label': label}
+        for label in self.math_labels(math):
+            self.equation_count += 1
+            self.add_reference('math',
+                               self.number('math', self.equation_count),
+                               label)
+            self.note_position(label)
 
     def figure_replacement(self, key, value, format, metadata):
         """Replace figures with appropriate representation.
@@ -293,46 +1166,59 @@ class ReferenceManager(object):
         The other way of doing it would be to pull out a '\label{(.*)}'
         from the caption of an Image and use that to update the references.
         """
-        _caption, (filename, target), attrs = value
-        caption = pf.stringify(_caption)
+        _caption, (filename, target), (id, classes, kvs) = \
+            self.ast.figure(value)
+        caption = stringify(_caption)
+
+        ref = None
+        if 'unnumbered' not in classes:
+            self.fig_replacement_count += 1
+            if not id:
+                id = self.auto_fig_id(self.fig_replacement_count)
 
-        attr = PandocAttributes(attrs)
+            ref = self.references.get(id)
+            if ref is None:
+                # found in this pass but not when collecting
+                self.diagnostics.append(Diagnostic('mismatch', id, 'figure',
+                                                   None))
 
-        if 'unnumbered' in attr.classes:
+        if ref is None:
             star = '*'
             fcaption = caption
         else:
-            self.fig_replacement_count += 1
-            if not attr.id:
-                attr.id = self.auto_fig_id(self.fig_replacement_count)
-
-            ref = self.references[attr.id]
             star = ''
             if caption:
-                fcaption = u'Figure {n}: {caption}'.format(n=ref['id'],
+                fcaption = u'Figure {n}: {caption}'.format(n=ref.id,
                                                            caption=caption)
             else:
-                fcaption = u'Figure {n}'.format(n=ref['id'])
+                fcaption = u'Figure {n}'.format(n=ref.id)
 
-        if 'figure' not in attr.classes:
-            attr.classes.insert(0, 'figure')
+        if 'figure' not in classes:
+            classes = ['figure'] + classes
+        kvs = unique_kvs(kvs)
 
         if format in self.formats:
-            figure = self.figure_styles[format].format(attr=attr,
-                                                       filename=filename,
-                                                       alt=fcaption,
-                                                       fcaption=fcaption,
-                                                       caption=caption,
-                                                       star=star).encode('utf-8')
+            figure = self.figure_template(format).render(id, classes, kvs,
+                                                         filename=filename,
+                                                         alt=fcaption,
+                                                         fcaption=fcaption,
+                                                         caption=caption,
+                                                         star=star)
 
             return RawBlock(format, figure)
 
         else:
-            alt = [pf.Str(fcaption)]
-            target = (filename, '')
-            image = pf.Image(alt, target)
-            figure = pf.Para([image])
-            return pf.Div(attr.to_pandoc(), [figure])
+            return self.ast.figure_block([id, classes, kvs],
+                                         [pf.Str(fcaption)], filename)
+
+    def figure_template(self, format):
+        """The compiled FigureTemplate of the figure style for format."""
+        style = self.figure_styles[format]
+        try:
+            return self.figure_templates[style]
+        except KeyError:
+            template = self.figure_templates[style] = FigureTemplate(style)
+            return template
 
     def section_replacement(self, key, value, format, metadata):
         """Replace sections with appropriate representation.
@@ -344,7 +1230,7 @@ class ReferenceManager(object):
             pretext = ''
         else:
             ref = self.references[label]
-            pretext = '{}: '.format(ref['id'])
+            pretext = '{}: '.format(ref.id)
 
         pretext = [pf.Str(pretext)]
 
@@ -365,16 +1251,16 @@ class ReferenceManager(object):
         http://meta.math.stackexchange.com/questions/3764/equation-and-equation-is-the-same-for-me
         """
         mathtype, math = value
-        label = re.findall(math_label, math)[-1]
-
-        attr = PandocAttributes()
-        attr.id = '#' + label
 
         if format == 'latex':
             return pf.Math(mathtype, math)
 
-        else:
-            return pf.Span(attr.to_pandoc(), [pf.Math(mathtype, math)])
+        # nest a span for each label around the math, so that each
+        # label of a multi line equation can be linked to
+        span = pf.Math(mathtype, math)
+        for label in reversed(self.math_labels(math)):
+            span = pf.Span(['#' + label, [], []], [span])
+        return span
 
     def convert_internal_refs(self, key, value, format, metadata):
         """Convert all internal links from '#blah' into format
@@ -392,15 +1278,18 @@ class ReferenceManager(object):
             is bibliographic, and we want LaTeX to handle it, so just
             return unmodified.
             '''
-            for citation in citations:
-                if citation['citationId'] not in self.references: return
-            return self.convert_multiref(key, value, format, metadata)
+            references = self.references
+            refs = [references.get(citation['citationId'])
+                    for citation in citations]
+            if None in refs:
+                return
+            return self.convert_multiref(key, value, format, metadata, refs)
 
         else:
             citation = citations[0]
 
-        prefix = pf.stringify(citation['citationPrefix'])
-        suffix = pf.stringify(citation['citationSuffix'])
+        prefix = stringify(citation['citationPrefix'])
+        suffix = stringify(citation['citationSuffix'])
 
         if prefix:
             prefix += ' '
@@ -410,8 +1299,7 @@ class ReferenceManager(object):
         if label not in self.references:
             return
 
-        rtype = self.references[label]['type']
-        n = self.references[label]['id']
+        rtype, n, _ = self.references[label]
         text = self.replacements[rtype].format(n)
 
         if format == 'latex' and self.autoref:
@@ -428,12 +1316,16 @@ class ReferenceManager(object):
 
         else:
             link_text = '{}{}{}'.format(prefix, text, suffix)
-            link = pf.Link([pf.Str(link_text)], ('#' + label, ''))
+            link = self.ast.Link([pf.Str(link_text)], ('#' + label, ''))
             return link
 
-    def convert_multiref(self, key, value, format, metadata):
+    def convert_multiref(self, key, value, format, metadata, refs=None):
         """Convert all internal links from '#blah' into format
         specified in self.replacements.
+
+        The references are grouped by type, in the order that each
+        type is first cited, and consecutive numbers are written as
+        ranges.
         """
         citations, inlines = value
 
@@ -446,38 +1338,128 @@ class ReferenceManager(object):
             return RawInline('latex', link)
 
         elif format == 'latex' and not self.autoref:
-            link = ''.join(create_latex_multilink(labels))
+            link = ''.join(create_latex_multilink(labels, **self.separators))
             return RawInline('latex', link)
 
         else:
-            D = [self.references[label] for label in labels]
-            # uniquely ordered types
-            types = list(OrderedDict.fromkeys(d['type'] for d in D))
+            if refs is None:
+                refs = [self.references[label] for label in labels]
 
-            links = []
+            # group by type, in order of first appearance
+            groups = OrderedDict()
+            for ref in refs:
+                groups.setdefault(ref.type, []).append(ref)
 
-            for t in set(types):
-                n = [d['id'] for d in D if d['type'] == t]
-                labels = ['#' + d['label'] for d in D if d['type'] == t]
-                multi_link = create_pandoc_multilink(n, labels)
+            links = []
 
-                if len(labels) == 1:
-                    multi_link.insert(0,
-                                      pf.Str(self.replacements[t].format('')))
+            for t, group in groups.items():
+                if len(group) == 1:
+                    multi_link = [pf.Str(self.replacements[t].format(''))]
                 else:
-                    multi_link.insert(0, pf.Str(self.multi_replacements[t]))
+                    multi_link = [pf.Str(self.multi_replacements[t])]
+
+                multi_link.extend(create_pandoc_multilink(
+                    group, self.range_separator, self.min_range,
+                    self.ast.Link, **self.separators))
 
                 links.append(multi_link)
 
-            return join_items(links, method='extend')
+            return join_items(links, method='extend', **self.separators)
 
     @property
     def reference_filter(self):
-        return [create_figures,
+        return [self.ast.create_figures,
                 self.consume_references,
                 self.replace_references,
                 self.convert_internal_refs]
 
+    @property
+    def reference_passes(self):
+        """The reference_filter grouped into the actions that can
+        share a single walk of the document: one pass to collect
+        labels and one pass to rewrite.
+        """
+        return [[self.ast.create_figures, self.consume_references],
+                [self.replace_references, self.convert_internal_refs]]
+
+
+def load_json_backend(name):
+    """Return the loads, dumps and dumpb functions of the named json
+    library, where loads takes text or utf-8 bytes, dumps returns
+    text and dumpb returns utf-8 bytes.
+    """
+    if name == 'orjson':
+        import orjson
+
+        def dumps(obj):
+            return orjson.dumps(obj).decode('utf-8')
+
+        return orjson.loads, dumps, orjson.dumps
+
+    elif name == 'ujson':
+        import ujson
+
+        def dumps(obj):
+            return ujson.dumps(obj, escape_forward_slashes=False)
+
+        def dumpb(obj):
+            return dumps(obj).encode('utf-8')
+
+        return ujson.loads, dumps, dumpb
+
+    elif name == 'json':
+        def loads(s):
+            # json.loads only takes bytes from python 3.6
+            if isinstance(s, bytes):
+                s = s.decode('utf-8')
+            return pf.json.loads(s)
+
+        def dumpb(obj):
+            return pf.json.dumps(obj).encode('utf-8')
+
+        return loads, pf.json.dumps, dumpb
+
+    else:
+        raise ValueError('unknown json backend {!r}'.format(name))
+
+
+class JSONBackend(object):
+    """The json library used to read and write documents.
+
+    This is the fastest of json_backends that is installed, unless
+    a name is given (e.g. with the INTERNAL_REFERENCES_JSON
+    environment variable). The standard library is always available.
+    Its loads, dumps and dumpb are those of load_json_backend.
+    """
+    json_backends = ('orjson', 'ujson', 'json')
+
+    def __init__(self, name=None):
+        for candidate in ([name] if name else self.json_backends):
+            try:
+                self.loads, self.dumps, self.dumpb = \
+                    load_json_backend(candidate)
+            except ImportError:
+                if name:
+                    raise
+            else:
+                self.name = candidate
+                break
+
+        # the separator used between items in arrays, e.g. ', '
+        self.separator = self.dumps([0, 0])[2:-2]
+        # and between keys and values in objects, e.g. ': '
+        self.key_separator = self.dumps({'': 0})[3:-2]
+
+    def load(self, f):
+        return self.loads(f.read())
+
+    def dump(self, obj, f):
+        """Write obj to the text file f."""
+        f.write(self.dumps(obj))
+
+
+json_backend = JSONBackend(os.environ.get('INTERNAL_REFERENCES_JSON'))
+
 
 def toJSONFilter(actions):
     """Modified from pandocfilters to accept a list of actions (to
@@ -501,40 +1483,1337 @@ def toJSONFilter(actions):
     the list to which the target object belongs.  (So, returning an
     empty list deletes the object.)
     """
-    doc = pf.json.loads(pf.sys.stdin.read())
+    stdin = getattr(pf.sys.stdin, 'buffer', pf.sys.stdin)
+    doc = json_backend.load(stdin)
     if len(pf.sys.argv) > 1:
         format = pf.sys.argv[1]
     else:
         format = ""
 
+    metadata = pandoc_ast(doc).meta(doc)
     if type(actions) is type(toJSONFilter):
-        altered = pf.walk(doc, actions, format, doc[0]['unMeta'])
+        altered = pf.walk(doc, actions, format, metadata)
     elif type(actions) is list:
         altered = doc
         for action in actions:
-            altered = pf.walk(altered, action, format, doc[0]['unMeta'])
+            altered = pf.walk(altered, action, format, metadata)
 
-    pf.json.dump(altered, pf.sys.stdout)
+    stdout = getattr(pf.sys.stdout, 'buffer', pf.sys.stdout)
+    stdout.write(json_backend.dumpb(altered))
 
 
-def main():
-    doc = pf.json.loads(pf.sys.stdin.read())
-    if len(pf.sys.argv) > 1:
-        format = pf.sys.argv[1]
-    else:
-        format = ""
+def meta_string(value):
+    """The text of a metadata value, which could be a MetaString or
+    MetaInlines.
+    """
+    if isinstance(value, list):
+        return stringify(value)
+    return value
+
+
+def document_manager(metadata, ast=None):
+    """Create a new ReferenceManager configured by the document
+    metadata, for documents with the given PandocAST.
 
-    metadata = doc[0]['unMeta']
+    As well as autoref, the formatting of multiple references can be
+    set with multiref-separator (', '), multiref-last-separator
+    (' and '), multiref-range-separator (an en dash) and
+    multiref-min-range (3, the shortest run of consecutive numbers to
+    write as a range, or 0 for none).
+
+    Figures and equations are numbered through the document, unless
+    number-figures-within or number-equations-within give a header
+    level to number them within, e.g. 1 for 'Figure 3.2'.
+    """
     args = {k: v['c'] for k, v in metadata.items()}
     autoref = args.get('autoref', True)
 
-    refmanager = ReferenceManager(autoref=autoref)
+    options = {}
+    for key, option in (('multiref-separator', 'separator'),
+                        ('multiref-last-separator', 'last_separator'),
+                        ('multiref-range-separator', 'range_separator')):
+        if key in args:
+            options[option] = meta_string(args[key])
+    if 'multiref-min-range' in args:
+        options['min_range'] = int(meta_string(args['multiref-min-range']))
+
+    numbering = {}
+    for key, type in (('number-figures-within', 'figure'),
+                      ('number-equations-within', 'math')):
+        if key in args:
+            numbering[type] = int(meta_string(args[key]))
+    if numbering:
+        options['numbering'] = numbering
+
+    return ReferenceManager(autoref=autoref, ast=ast, **options)
+
+
+def meta_value(value):
+    """A pandoc metadata value for a python value (or a metadata value
+    as it is)."""
+    if isinstance(value, dict) and 't' in value:
+        return value
+    elif isinstance(value, bool):
+        return {'t': 'MetaBool', 'c': value}
+    else:
+        return {'t': 'MetaString', 'c': u'{}'.format(value)}
+
+
+def copy_tree(x):
+    """Copy the lists and dicts of a pandoc document."""
+    if isinstance(x, list):
+        return [copy_tree(item) for item in x]
+    elif isinstance(x, dict):
+        return {k: copy_tree(v) for k, v in x.items()}
+    return x
+
+
+def apply_filter(doc, format, metadata=None, profile=None, strict=False,
+                 processes=None):
+    """Apply the internal reference filter to a pandoc document in
+    place, with a new ReferenceManager, which is returned.
+
+    The metadata (a dict of python or pandoc metadata values) is used
+    in place of the document's own for those keys. If a Profile is
+    given, the passes are timed and counted with it. If strict, a
+    ValidationError is raised as soon as a pass finds problems with
+    the references (see ReferenceManager.validate). If processes is
+    given, large documents are rewritten in parallel with that many
+    processes (0 for one per cpu), see parallel_rewrite_pass.
+    """
+    ast = pandoc_ast(doc)
+    meta = ast.meta(doc)
+    if metadata:
+        meta = dict(meta)
+        meta.update((k, meta_value(v)) for k, v in metadata.items())
+    refmanager = document_manager(meta, ast)
+
+    if profile is None and processes is not None:
+        collect, rewrite = refmanager.reference_passes
+        splits = []
+        marked = collect_pass(doc, collect, refmanager, format, meta, splits)
+        if strict:
+            refmanager.check()
+        parallel_rewrite_pass(doc, rewrite, refmanager, marked, splits,
+                              format, meta, processes or None)
+    elif profile is None:
+        collect, rewrite = refmanager.reference_passes
+        marked = collect_pass(doc, collect, refmanager, format, meta)
+        if strict:
+            refmanager.check()
+        rewrite_pass(doc, rewrite, refmanager, marked, format, meta)
+    else:
+        profile.filter(doc, refmanager, format, meta, strict)
+
+    if strict:
+        refmanager.check()
+    return refmanager
+
+
+def filter_doc(doc, format, profile=None):
+    """Apply the internal reference filter to a pandoc document,
+    modifying it in place. A new ReferenceManager is used for each
+    document.
+
+    If a Profile is given, the passes are timed and counted with it.
+    """
+    apply_filter(doc, format, profile=profile)
+    return doc
+
+
+def process(doc, format, metadata=None, in_place=True, strict=False):
+    """Apply the internal reference filter to a pandoc document that
+    has already been loaded, e.g. with json.loads, for use from
+    python without going through pandoc's filter interface.
 
-    altered = doc
-    for action in refmanager.reference_filter:
-        altered = pf.walk(altered, action, format, metadata)
+    Returns the filtered document and the references found in it, a
+    dict of label: Reference(type, id, label). The document is
+    modified in place, unless in_place is False, when a copy is
+    filtered instead. The metadata, e.g. {'autoref': False},
+    overrides that of the document. If strict, a ValidationError is
+    raised if there are any problems with the references.
+
+    Nothing is shared between calls, so it is safe to call from many
+    threads at once (on different documents, if in place).
+    """
+    if not in_place:
+        doc = copy_tree(doc)
+    refmanager = apply_filter(doc, format, metadata, strict=strict)
+    return doc, dict(refmanager.references)
+
+
+def reference_table(refmanager):
+    """The references found by a ReferenceManager, as a list of dicts
+    with the label, type, number, the labels of the sections that
+    contain it (outermost first), the index of the top level block
+    that it is in and its source position, if known.
+    """
+    references = refmanager.references
+    table = []
+    for label, ref in references.items():
+        sections, block, pos = references.position(label)
+        table.append(OrderedDict([('label', label),
+                                  ('type', ref.type),
+                                  ('number', ref.id),
+                                  ('sections', list(sections)),
+                                  ('block', block),
+                                  ('pos', pos)]))
+    return table
+
+
+# the compact binary reference table: the magic and version, the
+# number of references, then for each the type (an index into
+# reference_types), label, number, source position, block (-1 if
+# unknown) and the number of sections followed by their labels.
+# Strings are utf-8, preceded by their length.
+table_magic = b'IREF\x01'
+
+
+def pack_string(s):
+    import struct
+    data = u'{}'.format(s).encode('utf-8')
+    return struct.pack('<H', len(data)) + data
+
+
+def write_reference_table(table, path):
+    """Write a reference_table to path, as json if the path ends in
+    .json and otherwise in the compact binary format.
+    """
+    if path.endswith('.json'):
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(u'{}'.format(json_backend.dumps(table)))
+        return
+
+    import struct
+    parts = [table_magic, struct.pack('<I', len(table))]
+    for ref in table:
+        parts.append(struct.pack('<B', reference_types.index(ref['type'])))
+        parts.append(pack_string(ref['label']))
+        parts.append(pack_string(ref['number']))
+        parts.append(pack_string(ref['pos'] or ''))
+        block = -1 if ref['block'] is None else ref['block']
+        parts.append(struct.pack('<iB', block, len(ref['sections'])))
+        parts.extend(pack_string(section) for section in ref['sections'])
+
+    with open(path, 'wb') as f:
+        f.write(b''.join(parts))
+
+
+def read_reference_table(path):
+    """Read a reference table written by write_reference_table."""
+    if path.endswith('.json'):
+        with io.open(path, encoding='utf-8') as f:
+            return json_backend.load(f)
+
+    import struct
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(table_magic):
+        raise ValueError('not a reference table: {}'.format(path))
+
+    pos = len(table_magic)
+
+    def unpack(fmt):
+        values = struct.unpack_from(fmt, data, pos)
+        return values, pos + struct.calcsize(fmt)
+
+    def string():
+        (length,), end = unpack('<H')
+        return data[end:end + length].decode('utf-8'), end + length
+
+    (count,), pos = unpack('<I')
+    table = []
+    for _ in range(count):
+        (type,), pos = unpack('<B')
+        type = reference_types[type]
+        label, pos = string()
+        number, pos = string()
+        source, pos = string()
+        (block, nsections), pos = unpack('<iB')
+        sections = []
+        for _ in range(nsections):
+            section, pos = string()
+            sections.append(section)
+        table.append(OrderedDict([
+            ('label', label),
+            ('type', type),
+            ('number', (int(number)
+                        if number.isdigit() and type != 'section'
+                        else number)),
+            ('sections', sections),
+            ('block', None if block == -1 else block),
+            ('pos', source or None)]))
+    return table
+
+
+class Profile(object):
+    """Timings and counts for a run of the filter, for finding out
+    where the time goes in a slow build.
+
+    Profiling is switched on with the INTERNAL_REFERENCES_PROFILE
+    environment variable or the --profile option. The report goes to
+    stderr, or to a json file if a path is given, e.g.
+    --profile=profile.json. When profiling is off none of this code
+    runs, so there is no cost.
+    """
+    handlers = ('consume_figure', 'consume_section', 'consume_math',
+                'figure_replacement', 'section_replacement',
+                'math_replacement', 'convert_multiref')
+
+    def __init__(self, path=None):
+        self.path = path
+        self.phases = OrderedDict()
+        self.actions = OrderedDict()
+        self.calls = Counter()
+        self.nodes = OrderedDict()
+        self.references = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = timer()
+        yield
+        self.phases[name] = self.phases.get(name, 0) + timer() - start
+
+    def action(self, action, nodes=None):
+        """Wrap an action so that its calls, the number of times that
+        it returns a replacement and the time spent in it are counted,
+        along with the types of node visited if nodes is a Counter.
+        """
+        stats = self.actions[action.__name__] = {'calls': 0,
+                                                 'fired': 0,
+                                                 'time': 0}
+
+        def profiled(key, value, format, meta):
+            start = timer()
+            res = action(key, value, format, meta)
+            stats['time'] += timer() - start
+            stats['calls'] += 1
+            if res is not None:
+                stats['fired'] += 1
+            if nodes is not None:
+                nodes[key] += 1
+            return res
+
+        return profiled
+
+    def handler(self, name, method):
+        def profiled(*args):
+            self.calls[name] += 1
+            return method(*args)
+
+        return profiled
+
+    def filter(self, doc, refmanager, format, metadata, strict=False):
+        """Walk the reference_passes over the document, as in
+        apply_filter, recording timings and counts.
+        """
+        for name in self.handlers:
+            setattr(refmanager, name,
+                    self.handler(name, getattr(refmanager, name)))
+
+        names = ('collect', 'rewrite')
+        passes = []
+        for name, actions in zip(names, refmanager.reference_passes):
+            nodes = self.nodes[name] = Counter()
+            passes.append([self.action(action, nodes if i == 0 else None)
+                           for i, action in enumerate(actions)])
+        collect, rewrite = passes
+        with self.phase('collect'):
+            marked = collect_pass(doc, collect, refmanager, format,
+                                  metadata)
+            if strict:
+                refmanager.check()
+        with self.phase('rewrite'):
+            rewrite_pass(doc, rewrite, refmanager, marked, format, metadata)
+
+        types = Counter(r.type for r in refmanager.references.values())
+        resolved = self.actions['convert_internal_refs']['fired']
+        self.references = {'figures': types['figure'],
+                           'sections': types['section'],
+                           'equations': types['math'],
+                           'citations': self.nodes['rewrite']['Cite'],
+                           'resolved': resolved,
+                           'unresolved': (self.nodes['rewrite']['Cite']
+                                          - resolved)}
+
+    def report(self):
+        return OrderedDict([('phases', self.phases),
+                            ('actions', self.actions),
+                            ('handlers', OrderedDict(sorted(
+                                self.calls.items()))),
+                            ('nodes', OrderedDict(
+                                (name, sum(nodes.values()))
+                                for name, nodes in self.nodes.items())),
+                            ('references', self.references)])
+
+    def write(self):
+        report = self.report()
+        if self.path:
+            with open(self.path, 'wb') as f:
+                f.write(pf.json.dumps(report, indent=2).encode('utf-8'))
+            return
+
+        lines = ['internal-references profile:']
+        for name, seconds in report['phases'].items():
+            lines.append('  {:<24} {:9.4f}s'.format(name, seconds))
+        for name, stats in report['actions'].items():
+            lines.append('  {:<24} {:9.4f}s {:>9} calls {:>7} fired'
+                         .format(name, stats['time'], stats['calls'],
+                                 stats['fired']))
+        for name, calls in report['handlers'].items():
+            lines.append('  {:<24} {:>9} calls'.format(name, calls))
+        for name, count in report['nodes'].items():
+            lines.append('  {:<24} {:>9} nodes'.format(name, count))
+        for name, count in sorted(report['references'].items()):
+            lines.append('  {:<24} {:>9}'.format(name, count))
+        pf.sys.stderr.write(u'\n'.join(lines) + u'\n')
+
+
+class JSONStreamReader(object):
+    """Read json values one at a time from a file, holding no more
+    than the current value (and a chunk of the file) in memory.
+    """
+    whitespace = ' \t\n\r'
+
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.decoder = pf.json.JSONDecoder()
+
+    def fill(self):
+        """Read more of the file into the buffer, at least doubling
+        the unread part so that retrying a long value is linear.
+        """
+        pending = self.buffer[self.pos:]
+        chunk = self.f.read(max(self.chunk_size, len(pending)))
+        self.buffer = pending + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        """The next non whitespace character."""
+        while True:
+            while self.pos < len(self.buffer) \
+                    and self.buffer[self.pos] in self.whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError('unexpected end of json')
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('expected {!r} but found {!r}'
+                             .format(char, found))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+            else:
+                self.pos = end
+                return value
+
+    def array(self):
+        """Iterate over the values in a json array."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ']':
+                self.pos += 1
+                return
+            self.expect(',')
+
+
+def document_ends(head):
+    """The json of a document before and after its list of blocks,
+    given everything but the blocks: the metadata in a list, for
+    old pandoc, or a dict of the rest of the document, which is
+    written with the blocks last.
+    """
+    dumps = json_backend.dumps
+    separator = json_backend.separator
+    if isinstance(head, dict):
+        start = u'{' + u''.join(
+            dumps(k) + json_backend.key_separator + dumps(v) + separator
+            for k, v in head.items())
+        start += dumps('blocks') + json_backend.key_separator
+        return start, u'}'
+    else:
+        return u'[' + dumps(head[0]) + separator, u']'
+
+
+def filter_stream(stdin, stdout, format, chunk_size=1 << 16, strict=False):
+    """Apply the internal reference filter to a pandoc document
+    without holding all of it in memory.
+
+    The blocks of the document are read one at a time and the
+    references collected from them, with the blocks kept in a
+    temporary file. The blocks are then read back from that file
+    and written out one at a time as they are replaced, after the
+    rest of the document (which includes the metadata). The output
+    is the same as that of dumping the whole filtered document.
+
+    Documents with a pandoc-api-version must have the blocks last,
+    as pandoc writes them, or a ValueError is raised. If strict,
+    nothing is written if there are problems with the references.
+    """
+    import tempfile
+    dumps = json_backend.dumps
+    separator = json_backend.separator
+
+    reader = JSONStreamReader(stdin, chunk_size)
+    if reader.peek() == '{':
+        reader.expect('{')
+        head = OrderedDict()
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key == 'blocks':
+                break
+            head[key] = reader.value()
+            reader.expect(',')
+    else:
+        reader.expect('[')
+        head = [reader.value()]
+        reader.expect(',')
+
+    ast = pandoc_ast(head)
+    metadata = ast.meta(head)
+    refmanager = document_manager(metadata, ast)
+    collect, rewrite = refmanager.reference_passes
+    walk(metadata, collect, format, metadata, opaque_types)
+
+    # the spool is binary, of utf-8 json, so it doesn't depend on the
+    # locale's encoding
+    with tempfile.TemporaryFile('w+b') as spool:
+        for i, block in enumerate(reader.array()):
+            refmanager.block = i
+            for block in walk([block], collect, format, metadata,
+                              opaque_types):
+                spool.write(json_backend.dumpb(block))
+                spool.write(b'\n')
+        if reader.peek() != ('}' if isinstance(head, dict) else ']'):
+            raise ValueError('the blocks must be last in the document')
+
+        if strict:
+            refmanager.check()
+        spool.seek(0)
+
+        walk(metadata, rewrite, format, metadata, opaque_types)
+        start, end = document_ends(head)
+        stdout.write(start + '[')
+        block_separator = ''
+        for line in spool:
+            for block in walk([json_backend.loads(line)], rewrite, format,
+                              metadata, opaque_types):
+                stdout.write(block_separator)
+                stdout.write(dumps(block))
+                block_separator = separator
+        stdout.write(']' + end)
+
+    return refmanager
+
+
+class OutputCache(object):
+    """A directory of filtered documents, keyed by a hash of the input
+    document, the output format, the json backend and the source of
+    the filter itself, so that unchanged documents don't have to be
+    filtered again.
+
+    The metadata (e.g. autoref) is part of the input document, so is
+    covered by the hash. Entries are written atomically, so that many
+    filters can share a cache, and once the cache is bigger than
+    max_size bytes the least recently used entries are removed.
+    """
+    suffix = '.json'
+
+    def __init__(self, directory, max_size=256 << 20):
+        self.directory = directory
+        self.max_size = max_size
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    @staticmethod
+    def filter_version():
+        """A hash of the source of the filter."""
+        import hashlib
+        with open(__file__.replace('.pyc', '.py'), 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def key(self, data, format):
+        import hashlib
+        h = hashlib.sha1()
+        for part in (self.filter_version(), format, json_backend.name):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        h.update(data)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key, out):
+        """Copy the cached output for key to the binary file out,
+        returning whether there was one.
+        """
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            return False
+        with f:
+            import shutil
+            shutil.copyfileobj(f, out)
+        try:
+            # the modification time records when an entry was last used
+            os.utime(path, None)
+        except OSError:
+            pass
+        return True
+
+    def put(self, key, data):
+        """Store the output (bytes) for key, evicting old entries if
+        the cache is full.
+        """
+        if len(data) > self.max_size:
+            return
+        import tempfile
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            getattr(os, 'replace', os.rename)(tmp, self.path(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is
+        no bigger than max_size.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(entry[1] for entry in entries)
+        for _mtime, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+
+
+def filter_cached(cache, stdin, stdout, format):
+    """Apply the internal reference filter to the document read from
+    the binary file stdin, writing it to the binary file stdout,
+    using the OutputCache. On a hit the cached output is copied to
+    stdout without parsing the document.
+    """
+    data = stdin.read()
+    key = cache.key(data, format)
+    if cache.get(key, stdout):
+        return
+
+    doc = json_backend.loads(data)
+    filter_doc(doc, format)
+    output = json_backend.dumps(doc).encode('utf-8')
+    stdout.write(output)
+    cache.put(key, output)
+
+
+class FilterHandler(object):
+    """Filter a single document sent by internalreferences_client.
+
+    The request is the output format on the first line (optionally
+    followed by a space and an id for the document, see WatchHandler)
+    followed by the pandoc json. The response is 'ok' on the first
+    line followed by the filtered json, or 'error' followed by a
+    traceback.
+
+    This is a socketserver request handler, as StreamRequestHandler,
+    written out so that socketserver is only imported by serve.
+    """
+    def __init__(self, request, client_address, server):
+        self.rfile = request.makefile('rb')
+        self.wfile = request.makefile('wb')
+        try:
+            self.handle()
+        finally:
+            self.wfile.close()
+            self.rfile.close()
+
+    def handle(self):
+        line = self.rfile.readline().decode('utf-8').strip()
+        format, _, document = line.partition(' ')
+        try:
+            altered = self.filter(self.rfile.read(), format, document)
+        except Exception:
+            import traceback
+            self.wfile.write(b'error\n')
+            self.wfile.write(traceback.format_exc().encode('utf-8'))
+        else:
+            self.wfile.write(b'ok\n')
+            self.wfile.write(altered.encode('utf-8'))
+
+    def filter(self, data, format, document=None):
+        """The filtered json of the pandoc json data."""
+        doc = json_backend.loads(data)
+        return json_backend.dumps(filter_doc(doc, format))
+
+
+class IncrementalBlock(object):
+    """What an IncrementalFilter keeps of a top level block: the block
+    as it was given, the counters before and after it, the references
+    it defines, the labels it cites, whether it has anything to
+    rewrite, its json after the collect pass and its filtered json
+    (which is None until it has been rewritten).
+    """
+    def __init__(self, source, counters, end_counters, references,
+                 citations, rewrites, collected):
+        self.source = source
+        self.counters = counters
+        self.end_counters = end_counters
+        self.references = references
+        self.labels = set(references) | citations
+        self.rewrites = rewrites
+        self.collected = collected
+        self.output = None
+
+
+class IncrementalFilter(object):
+    """Filter successive versions of a document to one format, e.g.
+    on every save for a live preview, doing only the work that the
+    changes since the last version need.
+
+    The top level blocks of each version are compared with those of
+    the last one (as python objects, so that only the blocks that
+    changed are dumped). References are collected again only from
+    the blocks that changed and those after them whose numbering changed (e.g.
+    after a new header), and blocks are only rewritten again if they
+    were collected again or define or cite a reference that changed.
+    The output of the other blocks is kept from the last version. If
+    anything but the blocks changed (e.g. the metadata) the whole
+    document is filtered again.
+
+    collected and rewritten are the numbers of blocks that were, for
+    the last version.
+    """
+    def __init__(self, format):
+        self.format = format
+        self.head = None
+        self.blocks = []
+        self.references = {}
+        self.collected = self.rewritten = 0
+
+    def filter(self, doc):
+        """Filter the pandoc document doc, returning the json of the
+        result. The document itself is left part filtered.
+        """
+        dumps = json_backend.dumps
+        format = self.format
+        ast = pandoc_ast(doc)
+        meta = ast.meta(doc)
+        if isinstance(doc, dict):
+            head = OrderedDict((k, v) for k, v in doc.items()
+                               if k != 'blocks')
+        else:
+            head = doc[:1]
+        head_source = dumps(head)
+        old = self.blocks if head_source == self.head else []
+
+        refmanager = document_manager(meta, ast)
+        collect, rewrite = refmanager.reference_passes
+        citations = set()
+
+        def collect_citations(key, value, format, metadata):
+            if key == 'Cite':
+                citations.update(c['citationId'] for c in value[0])
+
+        collect = collect + [collect_citations]
+        walk(meta, collect, format, meta, opaque_types)
+        references = dict(refmanager.references)
+        counters = refmanager.counters
+
+        # the unchanged blocks at the start and end
+        new = ast.blocks(doc)
+        prefix = 0
+        while (prefix < min(len(old), len(new))
+               and old[prefix].source == new[prefix]):
+            prefix += 1
+        suffix = 0
+        while (suffix < min(len(old), len(new)) - prefix
+               and old[-1 - suffix].source == new[-1 - suffix]):
+            suffix += 1
+
+        blocks = []
+        collected = {}
+        for i, source in enumerate(new):
+            if i < prefix:
+                block = old[i]
+            elif i >= len(new) - suffix:
+                block = old[i - len(new) + len(old)]
+            else:
+                block = None
+
+            if block is None or block.counters != counters:
+                refmanager.reset(counters)
+                refmanager.rewrites = False
+                refmanager.block = i
+                citations.clear()
+                # collect from a copy, keeping the block as it was given
+                # to compare with the next version
+                collected[i] = [json_backend.loads(dumps(source))]
+                walk_item(collected[i], 0, collect, format, meta,
+                          opaque_types)
+                block = IncrementalBlock(source, counters,
+                                         refmanager.counters,
+                                         dict(refmanager.references),
+                                         set(citations), refmanager.rewrites,
+                                         dumps(collected[i]))
+            blocks.append(block)
+            counters = block.end_counters
+            references.update(block.references)
+
+        changed = set(label for label in set(references) | set(self.references)
+                      if references.get(label)
+                      != self.references.get(label))
+
+        refmanager.references = references
+        walk(meta, rewrite, format, meta, opaque_types)
+        rewritten = 0
+        for i, block in enumerate(blocks):
+            if block.output is not None and block.labels.isdisjoint(changed):
+                continue
+            items = collected.get(i)
+            if items is None:
+                items = json_backend.loads(block.collected)
+            if block.rewrites:
+                refmanager.fig_replacement_count = block.counters[
+                    'figure_count']
+                walk(items, rewrite, format, meta, opaque_types)
+            block.output = json_backend.separator.join(dumps(item)
+                                                       for item in items)
+            rewritten += 1
+
+        self.head = head_source
+        self.blocks = blocks
+        self.references = references
+        self.collected = len(collected)
+        self.rewritten = rewritten
+
+        start, end = document_ends(head)
+        return start + u'[' + json_backend.separator.join(
+            block.output for block in blocks if block.output) + u']' + end
+
+
+class WatchHandler(FilterHandler):
+    """Filter the documents sent by internalreferences_client with an
+    IncrementalFilter for each document and output format, for --watch.
+
+    Documents are told apart by the id that the client sends (from
+    INTERNAL_REFERENCES_DOCUMENT, e.g. the path of the document) or,
+    without one, by their metadata. Only the watch_documents most
+    recently filtered are kept.
+    """
+    documents = OrderedDict()
+    watch_documents = 16
+
+    def filter(self, data, format, document=None):
+        doc = json_backend.loads(data)
+        if not document:
+            ast = pandoc_ast(doc)
+            document = json_backend.dumps(ast.meta(doc))
+        key = (format, document)
+        incremental = self.documents.pop(key, None)
+        if incremental is None:
+            incremental = IncrementalFilter(format)
+        self.documents[key] = incremental
+        while len(self.documents) > self.watch_documents:
+            self.documents.popitem(last=False)
+        return incremental.filter(doc)
+
+
+def serve(path=None, watch=False):
+    """Run the filter as a long lived server on a unix socket, so
+    that the cost of starting python is only paid once.
+
+    If watch, the server keeps the last version of the document sent
+    for each format and filters each new version incrementally (see
+    IncrementalFilter), one at a time.
+    """
+    import signal
+    try:
+        import socketserver
+    except ImportError:  # python 2
+        import SocketServer as socketserver
+
+    import stat
+
+    path = path or socket_path()
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    # anyone who can write to the directory could replace the socket,
+    # unless it has the sticky bit (as /tmp does)
+    mode = os.stat(directory).st_mode
+    if not mode & stat.S_ISVTX and not (owned(directory)
+                                        and not mode & 0o022):
+        raise ValueError("{} isn't private to this user"
+                         .format(directory))
+    if os.path.lexists(path):
+        if not owned(path):
+            raise ValueError('{} belongs to another user'.format(path))
+        os.remove(path)
+
+    if watch:
+        server = socketserver.UnixStreamServer(path, WatchHandler)
+    else:
+        server = socketserver.ThreadingUnixStreamServer(path, FilterHandler)
+    os.chmod(path, 0o600)
+    server.daemon_threads = True
+    signal.signal(signal.SIGTERM, lambda signum, frame: pf.sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def filter_file(path, format, output):
+    """Filter the pandoc json in path, writing the result to output."""
+    with open(path, 'rb') as f:
+        doc = json_backend.load(f)
+
+    filter_doc(doc, format)
+
+    with open(output, 'wb') as f:
+        f.write(json_backend.dumpb(doc))
+
+    return output
+
+
+class ReferenceIndex(object):
+    """Persistent index of the references in a book that is made of
+    many documents (chapters), stored in sqlite.
+
+    Numbering continues from one chapter to the next, and citations
+    can refer to labels in any chapter. The index remembers the
+    content hash, starting counters and references of every chapter,
+    so that when the book is rebuilt only the chapters that changed,
+    or whose references changed, need to be filtered again.
+
+    References are kept for each chapter, so a label that is defined
+    in more than one chapter is noted as a 'duplicate' Diagnostic in
+    diagnostics by update. A chapter's own definition of a label is
+    the one it uses, and otherwise the first in the book.
+    """
+    # the user_version of the schema; older indexes are rebuilt
+    version = 2
+    schema = """
+        CREATE TABLE IF NOT EXISTS chapters (
+            path TEXT PRIMARY KEY,
+            position INTEGER,
+            hash TEXT,
+            format TEXT,
+            counters TEXT,
+            end_counters TEXT
+        );
+        CREATE TABLE IF NOT EXISTS refs (
+            chapter TEXT,
+            label TEXT,
+            type TEXT,
+            id,
+            PRIMARY KEY (chapter, label)
+        );
+        CREATE TABLE IF NOT EXISTS citations (
+            chapter TEXT,
+            label TEXT
+        );
+        CREATE INDEX IF NOT EXISTS chapter_refs ON refs (chapter);
+        CREATE INDEX IF NOT EXISTS chapter_citations ON citations (chapter);
+    """
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.diagnostics = []
+        version, = self.db.execute('PRAGMA user_version').fetchone()
+        if version != self.version:
+            self.db.executescript('DROP TABLE IF EXISTS chapters;'
+                                  ' DROP TABLE IF EXISTS refs;'
+                                  ' DROP TABLE IF EXISTS citations;')
+            self.db.execute('PRAGMA user_version = {:d}'.format(
+                self.version))
+        self.db.executescript(self.schema)
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def content_hash(path):
+        import hashlib
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def chapter(self, path):
+        """The hash, format, counters and end counters of a chapter."""
+        row = self.db.execute('SELECT hash, format, counters, end_counters'
+                              ' FROM chapters WHERE path = ?',
+                              (path,)).fetchone()
+        if row is None:
+            return None
+        hash, format, counters, end_counters = row
+        return (hash, format,
+                pf.json.loads(counters), pf.json.loads(end_counters))
+
+    def chapter_references(self, path):
+        """The references defined in a chapter."""
+        rows = self.db.execute('SELECT type, id, label FROM refs'
+                               ' WHERE chapter = ?', (path,))
+        return {label: Reference(type, id, label) for type, id, label in rows}
+
+    def cited_references(self, path):
+        """The references that a chapter needs in order to be
+        filtered: its own and any that it cites from other chapters.
+        """
+        rows = self.db.execute('SELECT type, id, label FROM refs'
+                               ' JOIN chapters ON path = chapter'
+                               ' WHERE chapter = ? OR label IN'
+                               ' (SELECT label FROM citations'
+                               '  WHERE chapter = ?)'
+                               ' ORDER BY chapter = ?, position DESC',
+                               (path, path, path))
+        return {label: Reference(type, id, label) for type, id, label in rows}
+
+    def duplicates(self):
+        """A 'duplicate' Diagnostic for each definition of a label
+        after the first, in book order."""
+        rows = self.db.execute('SELECT r.label, r.type FROM refs AS r'
+                               ' JOIN chapters AS c ON c.path = r.chapter'
+                               ' WHERE r.label != \'\' AND EXISTS'
+                               ' (SELECT 1 FROM refs AS o'
+                               '  JOIN chapters AS oc ON oc.path = o.chapter'
+                               '  WHERE o.label = r.label'
+                               '  AND oc.position < c.position)'
+                               ' ORDER BY c.position, r.label')
+        return [Diagnostic('duplicate', label, type, None)
+                for label, type in rows]
+
+    def collect(self, path, counters):
+        """Collect the references in the chapter at path, numbering
+        from the given counters. Returns the manager and the set of
+        cited labels.
+        """
+        with io.open(path, encoding='utf-8') as f:
+            doc = json_backend.load(f)
+
+        ast = pandoc_ast(doc)
+        metadata = ast.meta(doc)
+        refmanager = document_manager(metadata, ast)
+        refmanager.reset(counters)
+        citations = set()
+
+        def collect_citations(key, value, format, metadata):
+            if key == 'Cite':
+                citations.update(c['citationId'] for c in value[0])
+
+        actions = [ast.create_figures,
+                   refmanager.consume_references,
+                   collect_citations]
+        walk(doc, actions, '', metadata)
+
+        return refmanager, citations
+
+    def update(self, jobs):
+        """Bring the index up to date with the chapters given by the
+        (input, format, output) jobs, in book order.
+
+        Returns the jobs that need to be filtered again. Labels that
+        are defined in more than one chapter are left in diagnostics.
+        """
+        paths = [input for input, _, _ in jobs]
+        changed = set()
+        dirty = set()
+
+        for (path,) in self.db.execute('SELECT path FROM chapters').fetchall():
+            if path not in paths:
+                changed.update(self.chapter_references(path))
+                self.remove(path)
+
+        counters = ReferenceManager().counters
+        for position, (input, format, output) in enumerate(jobs):
+            hash = self.content_hash(input)
+            stored = self.chapter(input)
+
+            if stored is not None and stored[0] == hash \
+                    and stored[2] == counters:
+                if stored[1] != format or not os.path.exists(output):
+                    dirty.add(input)
+                self.db.execute('UPDATE chapters SET position = ?'
+                                ' WHERE path = ?', (position, input))
+                counters = stored[3]
+                continue
+
+            old = self.chapter_references(input)
+            refmanager, citations = self.collect(input, counters)
+            new = refmanager.references
+
+            changed.update(label for label in set(old) | set(new)
+                           if old.get(label) != new.get(label))
+            dirty.add(input)
+
+            self.remove(input)
+            self.db.execute('INSERT INTO chapters'
+                            ' VALUES (?, ?, ?, ?, ?, ?)',
+                            (input, position, hash, format,
+                             pf.json.dumps(counters),
+                             pf.json.dumps(refmanager.counters)))
+            self.db.executemany('INSERT INTO refs VALUES (?, ?, ?, ?)',
+                                [(input, r.label, r.type, r.id)
+                                 for r in new.values()])
+            self.db.executemany('INSERT INTO citations VALUES (?, ?)',
+                                [(input, label) for label in citations])
+            counters = refmanager.counters
+
+        if changed:
+            rows = self.db.execute('SELECT DISTINCT chapter FROM citations'
+                                   ' WHERE label IN ({})'.format(
+                                       ', '.join('?' * len(changed))),
+                                   list(changed))
+            dirty.update(path for (path,) in rows)
+
+        self.diagnostics = self.duplicates()
+        self.db.commit()
+
+        return [job for job in jobs if job[0] in dirty]
+
+    def remove(self, path):
+        for table, column in (('chapters', 'path'),
+                              ('refs', 'chapter'),
+                              ('citations', 'chapter')):
+            self.db.execute('DELETE FROM {} WHERE {} = ?'.format(table,
+                                                                 column),
+                            (path,))
+
+
+def filter_chapter(index_path, path, format, output):
+    """Filter a chapter of a book, using the references and starting
+    counters in the ReferenceIndex at index_path.
+    """
+    index = ReferenceIndex(index_path)
+    try:
+        _, _, counters, _ = index.chapter(path)
+        references = index.cited_references(path)
+    finally:
+        index.close()
+
+    with open(path, 'rb') as f:
+        doc = json_backend.load(f)
+
+    ast = pandoc_ast(doc)
+    metadata = ast.meta(doc)
+    refmanager = document_manager(metadata, ast)
+    refmanager.reset(counters)
+    refmanager.references.update(references)
+
+    walk(doc, [ast.create_figures], format, metadata)
+    walk(doc, refmanager.reference_passes[1], format, metadata)
+
+    with open(output, 'wb') as f:
+        f.write(json_backend.dumpb(doc))
+
+    return output
+
+
+def batch_jobs(path, format, suffix='.filtered.json'):
+    """List the (input, format, output) to filter for a batch path.
+
+    A directory means all of the json files in it, filtered to the
+    given format. Any other file is a manifest, with a json file and
+    optionally its format on each line, relative to the manifest.
+    """
+    if os.path.isdir(path):
+        names = sorted(n for n in os.listdir(path)
+                       if n.endswith('.json') and not n.endswith(suffix))
+        entries = [(os.path.join(path, n), format) for n in names]
+    else:
+        root = os.path.dirname(path)
+        entries = []
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                fields = line.split('#', 1)[0].split()
+                if fields:
+                    entries.append((os.path.join(root, fields[0]),
+                                    fields[1] if len(fields) > 1 else format))
+
+    return [(input, fmt, os.path.splitext(input)[0] + suffix)
+            for input, fmt in entries]
+
+
+def batch(argv):
+    """Filter many pandoc json documents, in parallel over a pool of
+    processes, writing the output next to each input.
+    """
+    import argparse
+    from concurrent import futures
+
+    parser = argparse.ArgumentParser(prog='internal-references batch')
+    parser.add_argument('paths', nargs='+',
+                        help='directories of pandoc json, or manifests')
+    parser.add_argument('-t', '--to', default='',
+                        help='output format, unless given in a manifest')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--index', default=None,
+                        help='treat the documents as chapters of a book,'
+                             ' numbered in order, with references kept in'
+                             ' this index and only changed chapters'
+                             ' filtered again')
+    args = parser.parse_args(argv)
+
+    jobs = [job for path in args.paths for job in batch_jobs(path, args.to)]
+
+    if args.index:
+        index = ReferenceIndex(args.index)
+        try:
+            jobs = index.update(jobs)
+        finally:
+            index.close()
+        write_diagnostics(index.diagnostics, pf.sys.stderr)
+        tasks = [(filter_chapter, args.index) + job for job in jobs]
+    else:
+        tasks = [(filter_file,) + job for job in jobs]
+
+    failed = 0
+    with futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = {executor.submit(*task): task[-3:] for task in tasks}
+        for result in futures.as_completed(results):
+            try:
+                result.result()
+            except Exception as e:
+                failed += 1
+                pf.sys.stderr.write(u'{}: {}\n'.format(results[result][0], e))
+
+    if failed:
+        pf.sys.exit(1)
+
+
+def main():
+    if pf.sys.argv[1:2] == ['--serve']:
+        return serve(*pf.sys.argv[2:3])
+    elif pf.sys.argv[1:2] == ['--watch']:
+        return serve(*pf.sys.argv[2:3], watch=True)
+    elif pf.sys.argv[1:2] == ['batch']:
+        return batch(pf.sys.argv[2:])
+
+    profile = os.environ.get('INTERNAL_REFERENCES_PROFILE')
+    table = os.environ.get('INTERNAL_REFERENCES_TABLE')
+    validate = os.environ.get('INTERNAL_REFERENCES_VALIDATE')
+    strict = os.environ.get('INTERNAL_REFERENCES_STRICT')
+    argv = []
+    for arg in pf.sys.argv[1:]:
+        if arg == '--profile' or arg.startswith('--profile='):
+            profile = arg.partition('=')[2] or '1'
+        elif arg.startswith('--table='):
+            table = arg.partition('=')[2]
+        elif arg == '--validate':
+            validate = '1'
+        elif arg == '--strict':
+            strict = '1'
+        else:
+            argv.append(arg)
+
+    if argv:
+        format = argv[0]
+    else:
+        format = ""
+
+    try:
+        refmanager = filter_stdio(format, profile, bool(strict),
+                                  shortcuts=not (table or validate))
+    except ValidationError as e:
+        write_diagnostics(e.diagnostics, pf.sys.stderr)
+        pf.sys.exit(1)
+
+    if table:
+        write_reference_table(reference_table(refmanager), table)
+    if validate:
+        write_diagnostics(refmanager.validate(), pf.sys.stderr)
+
+
+def filter_stdio(format, profile=None, strict=False, shortcuts=True):
+    """Filter the document on stdin to stdout, streaming, through the
+    OutputCache or profiling as set by main. Returns the
+    ReferenceManager, or None if the output came from the cache or
+    the document was passed through unchanged, which are shortcuts
+    that are only taken if shortcuts is true.
+    """
+    # pandoc reads and writes utf-8, whatever the locale's encoding
+    stdin = getattr(pf.sys.stdin, 'buffer', pf.sys.stdin)
+    stdout = getattr(pf.sys.stdout, 'buffer', pf.sys.stdout)
+
+    if os.environ.get('INTERNAL_REFERENCES_STREAM'):
+        import codecs
+        return filter_stream(codecs.getreader('utf-8')(stdin),
+                             codecs.getwriter('utf-8')(stdout), format,
+                             strict=strict)
+
+    if not profile:
+        data = stdin.read()
+        if shortcuts and not needs_filter(data):
+            stdout.write(data)
+            return None
 
-    pf.json.dump(altered, pf.sys.stdout)
+        cache = shortcuts and os.environ.get('INTERNAL_REFERENCES_CACHE')
+        if cache and not strict:
+            size = os.environ.get('INTERNAL_REFERENCES_CACHE_SIZE')
+            cache = OutputCache(cache, *([int(size) << 20] if size else []))
+            return filter_cached(cache, io.BytesIO(data), stdout, format)
+
+        processes = os.environ.get('INTERNAL_REFERENCES_PARALLEL')
+        doc = json_backend.loads(data)
+        refmanager = apply_filter(doc, format, strict=strict,
+                                  processes=int(processes) if processes
+                                  else None)
+        stdout.write(json_backend.dumpb(doc))
+        return refmanager
+
+    profile = Profile(None if profile == '1' else profile)
+    with profile.phase('load'):
+        doc = json_backend.load(stdin)
+    refmanager = apply_filter(doc, format, profile=profile, strict=strict)
+    with profile.phase('dump'):
+        stdout.write(json_backend.dumpb(doc))
+    profile.write()
+    return refmanager
 
 
 if __name__ == '__main__':
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Minimal pandoc filter that forwards documents to a running
+`internal-references --serve` and writes back the result.
+
+Only the standard library needed to talk to the socket is imported
+here, and the socket only once there is a document to send, so that
+starting the client (or the filter, which imports this) is cheap. If
+no server is running the document is filtered in this process instead.
+Documents that have nothing for the filter to do are written straight
+back without either.
+"""
+import io
+import os
+import sys
+
+
+def socket_path():
+    """Location of the server socket, which can be set with the
+    INTERNAL_REFERENCES_SOCKET environment variable.
+
+    By default it is in the user's XDG_RUNTIME_DIR or, if there isn't
+    one, in a directory of $TMPDIR (or /tmp) named by the user's id,
+    which only the user can use, so that no one else can listen on it.
+    """
+    path = os.environ.get('INTERNAL_REFERENCES_SOCKET')
+    if path:
+        return path
+    directory = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(
+        os.environ.get('TMPDIR', '/tmp'),
+        'internal-references-{}'.format(os.getuid()))
+    return os.path.join(directory, 'internal-references.sock')
+
+
+def owned(path):
+    """Whether path belongs to this user, so that a socket there (or
+    anything in a directory there) wasn't put there by anyone else."""
+    return os.lstat(path).st_uid == os.getuid()
+
+
+# pandoc json that has any of these may have references to number or
+# replace, so a document without them can be passed through unchanged
+filter_tokens = (b'"Cite"', b'"Header"', b'"Image"', b'"Figure"',
+                 b'\\\\label')
+
+
+def needs_filter(data):
+    """Whether the raw pandoc json in data might be changed by the
+    filter, checked without parsing it.
+    """
+    return any(token in data for token in filter_tokens)
+
+
+def connect(path=None):
+    """Connect to the server, if the socket at path belongs to this
+    user, raising socket.error if not."""
+    import socket
+    path = path or socket_path()
+    try:
+        mine = owned(path)
+    except OSError as e:
+        raise socket.error(*e.args)
+    if not mine:
+        raise socket.error('{} belongs to another user'.format(path))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    return sock
+
+
+def forward(sock, format, stdin, stdout, chunk_size=1 << 16,
+            document=None):
+    """Send the pandoc json in stdin to the server and stream the
+    filtered json to stdout. The document is an id for it, for a
+    --watch server to keep its state by.
+
+    Returns None on success or the error message from the server.
+    """
+    import socket
+    line = format + (' ' + document if document else '')
+    sock.sendall(line.replace('\n', ' ').encode('utf-8') + b'\n')
+    for chunk in iter(lambda: stdin.read(chunk_size), b''):
+        sock.sendall(chunk)
+    sock.shutdown(socket.SHUT_WR)
+
+    response = sock.makefile('rb')
+    status = response.readline()
+    if status != b'ok\n':
+        return response.read().decode('utf-8')
+
+    for chunk in iter(lambda: response.read(chunk_size), b''):
+        stdout.write(chunk)
+
+
+def main():
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    data = stdin.read()
+    if not needs_filter(data):
+        stdout.write(data)
+        return
+
+    import socket
+    try:
+        sock = connect()
+    except socket.error:
+        import internalreferences
+        # stdin has been read, so hand the document over in its place
+        sys.stdin = io.TextIOWrapper(io.BytesIO(data), 'utf-8')
+        return internalreferences.main()
+
+    if len(sys.argv) > 1:
+        format = sys.argv[1]
+    else:
+        format = ""
+
+    try:
+        error = forward(sock, format, io.BytesIO(data), stdout,
+                        document=os.environ.get(
+                            'INTERNAL_REFERENCES_DOCUMENT'))
+    finally:
+        sock.close()
+
+    if error:
+        sys.stderr.write(error)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()